@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A stand-in for mu, good enough for the benchmarks. It answers 'mu find' from
+# the database written by maildir.scan, in the same sexp and plain formats mu
+# uses, and 'mu index' rescans the maildir.
+#
+# Queries are a conjunction of terms, optionally negated with NOT or '-':
+# tag:, flag:, maildir:, msgid:, date:FROM..TO, and bare words matched against
+# the subject. OR is not supported.
+
+import os
+import sys
+import json
+
+from datetime import datetime
+
+import maildir as md
+
+
+def sexp_string(s):
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def sexp_contacts(L):
+    return '(%s)' % ' '.join(['(%s . %s)' % (sexp_string(n), sexp_string(e)) for n, e in L])
+
+
+def sexp(r, thread=False):
+    date = int(r['date'])
+    L = [':docid %d' % r['docid'],
+         ':subject %s' % sexp_string(r['subject']),
+         ':from %s' % sexp_contacts(r['from']),
+         ':to %s' % sexp_contacts(r['to']),
+         ':date (%d %d 0)' % (date >> 16, date & 0xffff),
+         ':size %d' % r['size'],
+         ':message-id %s' % sexp_string(r['message-id']),
+         ':path %s' % sexp_string(r['path']),
+         ':maildir %s' % sexp_string(r['maildir']),
+         ':priority normal',
+         ':flags (%s)' % ' '.join(r['flags']),
+         ':tags (%s)' % ' '.join([sexp_string(t) for t in r['tags']])]
+    if thread:
+        L.append(':thread (:path %s :level %d)' % (sexp_string(r['thread']), r['thread'].count(':')))
+    return '(' + '\n '.join(L) + '\n)\n'
+
+
+
+# Queries
+# ----------------------------------------------
+
+def _parse_date(s, end=False):
+    if len(s) == 0: return None
+    s = s.ljust(14, '9' if end else '0')
+    if end: s = s[0:8] + min(s[8:10], '23') + min(s[10:12], '59') + min(s[12:14], '59')
+    try:
+        return datetime.strptime(s[0:14], '%Y%m%d%H%M%S').timestamp()
+    except ValueError:
+        return None
+
+
+def _term(tk):
+    """Returns a predicate on a database record for a query token"""
+    field, sep, value = tk.partition(':')
+    if not sep:
+        word = tk.lower()
+        return lambda r: word in r['subject'].lower()
+
+    field = field.lower()
+    if field in ['tag', 'x']:
+        return lambda r: value in r['tags']
+    elif field in ['flag', 'g']:
+        return lambda r: value in r['flags']
+    elif field in ['maildir', 'm']:
+        value = '/' + value.lstrip('/')
+        return lambda r: r['maildir'] == value
+    elif field in ['msgid', 'i']:
+        value = value.strip('<>')
+        return lambda r: r['message-id'] == value
+    elif field in ['date', 'd']:
+        a, b = value.split('..', 1) if '..' in value else (value, value)
+        start, stop = _parse_date(a), _parse_date(b, end=True)
+        return lambda r: (start == None or r['date'] >= start) and (stop == None or r['date'] <= stop)
+    else:
+        return lambda r: False
+
+
+def compile_query(tokens):
+    preds = []
+    neg = False
+    for tk in tokens:
+        tk = tk.strip('()')
+        if len(tk) == 0 or tk.upper() == 'AND': continue
+        if tk.upper() == 'NOT':
+            neg = not neg
+            continue
+        if tk[0] == '-':
+            neg = not neg
+            tk = tk[1:]
+
+        pred = _term(tk)
+        if neg: preds.append(lambda r, p=pred: not p(r))
+        else:   preds.append(pred)
+        neg = False
+
+    return lambda r: all([p(r) for p in preds])
+
+
+def load_db(muhome):
+    with open(os.path.join(muhome, md.DBNAME), 'r') as fd:
+        return [json.loads(line) for line in fd]
+
+
+
+# Commands
+# ----------------------------------------------
+
+def cmd_find(muhome, opts, tokens):
+    db = load_db(muhome)
+    match = compile_query(tokens)
+    L = [r for r in db if match(r)]
+
+    if 'after' in opts:
+        after = float(opts['after'])
+        L = [r for r in L if r['mtime'] > after]
+
+    if 'include-related' in opts:
+        roots = set([r['thread'].split(':')[0] for r in L])
+        L = [r for r in db if r['thread'].split(':')[0] in roots]
+
+    thread = 'threads' in opts
+    if thread: L.sort(key=lambda r: [int(x, 16) for x in r['thread'].split(':')])
+    else:      L.sort(key=lambda r: (r['date'], r['docid']))
+
+    if 'maxnum' in opts: L = L[0:int(opts['maxnum'])]
+
+    if len(L) == 0:
+        sys.stderr.write('mu: no matches for search expression\n')
+        return 4
+
+    out = sys.stdout
+    if opts.get('format', 'plain') == 'sexp':
+        for r in L: out.write(sexp(r, thread=thread))
+    else:
+        # only the path field is supported
+        for r in L: out.write(r['path'] + '\n')
+    return 0
+
+
+def cmd_index(muhome, opts, maildir):
+    if maildir == None:
+        sys.stderr.write('mu: no maildir to index\n')
+        return 1
+    md.scan(maildir, muhome)
+    return 0
+
+
+def main(argv):
+    if len(argv) < 1:
+        sys.stderr.write('usage: mu <command> [options]\n')
+        return 1
+
+    cmd = argv[0]
+    muhome = os.path.expanduser('~/.mu')
+    maildir = None
+    opts = {}
+    tokens = []
+
+    i = 1
+    while i < len(argv):
+        a = argv[i]
+        if a in ['--muhome', '--maildir'] and i + 1 < len(argv):
+            if a == '--muhome': muhome = argv[i+1]
+            else:               maildir = argv[i+1]
+            i = i + 2
+            continue
+        elif a.startswith('--'):
+            k, sep, v = a[2:].partition('=')
+            opts[k] = v
+        else:
+            tokens.append(a)
+        i = i + 1
+
+    if cmd == 'find':    return cmd_find(muhome, opts, tokens)
+    elif cmd == 'index': return cmd_index(muhome, opts, maildir)
+    else:
+        sys.stderr.write('mu: command %s not supported\n' % cmd)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
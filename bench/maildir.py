@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Synthetic maildirs for the benchmarks.
+#
+# generate() writes a maildir with gmail-like layout: every message lives in
+# 'All Mail', and messages with labels get a copy in the label folder as well.
+# Bodies follow a log-normal size distribution, and messages are grouped in
+# threads through In-Reply-To and References.
+#
+# scan() plays the role of mu index: it walks a maildir and writes the message
+# database the fake mu reads, one json object per line.
+#
+#   python3 bench/maildir.py [options] <maildir> <muhome>
+
+import os
+import re
+import json
+import random
+import hashlib
+import calendar
+import email.utils
+
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+# database file inside muhome
+DBNAME = 'fakemu.jsonl'
+
+# label -> folder holding the copies, and the share of messages carrying it
+LABELS = [('\\Inbox',     'INBOX',     0.30),
+          ('\\Sent',      'Sent',      0.10),
+          ('\\Important', 'Important', 0.05),
+          ('work',        'work',      0.15),
+          ('lists',       'lists',     0.25)]
+
+ALLMAIL = 'All Mail'
+TRASH = 'Trash'
+
+_flag_letters = {'D': 'draft', 'F': 'flagged', 'S': 'seen',
+                 'P': 'passed', 'R': 'replied', 'T': 'trashed'}
+
+_words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+          'tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+def _make_folder(path):
+    for sub in ['cur', 'new', 'tmp']:
+        os.makedirs(os.path.join(path, sub), exist_ok=True)
+
+
+def _body(rnd, size):
+    lines = []
+    total = 0
+    while total < size:
+        line = ' '.join([rnd.choice(_words) for i in range(12)])
+        lines.append(line)
+        total = total + len(line) + 1
+    return '\n'.join(lines) + '\n'
+
+
+def _senders(rnd, num):
+    L = []
+    for i in range(num):
+        if i % 5 == 0: L.append(('List %d' % i, 'list%d@lists.example.org' % i))
+        else:          L.append(('Person %d' % i, 'person%d@example.com' % i))
+    return L
+
+
+def generate(maildir, count=1000, seed=0, size_median=4000, size_sigma=1.0,
+             thread_depth=4, copies=True, days=3*365):
+    """Writes count messages under maildir. Returns the number of files, which
+    is larger than count when label copies are on."""
+    rnd = random.Random(seed)
+    senders = _senders(rnd, 50)
+    me = ('Me', 'me@example.com')
+    now = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    for folder in [ALLMAIL, TRASH] + [f for t, f, p in LABELS]:
+        _make_folder(os.path.join(maildir, folder))
+
+    nfiles = 0
+    uid = 0
+    thread = []           # message-ids of the current thread, root first
+    for n in range(count):
+        # start a new thread, or reply somewhere in the current one
+        if len(thread) == 0 or len(thread) >= thread_depth or rnd.random() < 0.5:
+            thread = []
+            subject = 'Message %d' % n
+
+        msgid = '<%d.%d@bench.example.com>' % (seed, n)
+        if len(thread) == 0: date = now - timedelta(seconds=int(rnd.random()*days*86400))
+        else:                date = date + timedelta(seconds=int(rnd.random()*2*86400))
+        sender = rnd.choice(senders)
+        size = int(rnd.lognormvariate(0, size_sigma) * size_median)
+
+        tags = set([t for t, f, p in LABELS if rnd.random() < p])
+        if sender[1].startswith('list'): tags.add('lists')
+
+        flags = ''
+        if rnd.random() < 0.05: flags = flags + 'F'
+        if rnd.random() < 0.80: flags = flags + 'S'
+
+        headers = [('From', email.utils.formataddr(sender)),
+                   ('To', email.utils.formataddr(me)),
+                   ('Subject', subject),
+                   ('Date', email.utils.formatdate(calendar.timegm(date.timetuple()))),
+                   ('Message-ID', msgid)]
+        if len(thread) > 0:
+            headers[2] = ('Subject', 'Re: ' + subject)
+            headers.append(('In-Reply-To', thread[-1]))
+            headers.append(('References', ' '.join(thread)))
+        headers.append(('X-Keywords', ', '.join(sorted(tags))))
+
+        content = ''.join(['%s: %s\n' % h for h in headers]) + '\n' + _body(rnd, size)
+        content = content.encode('utf-8')
+
+        folders = [ALLMAIL]
+        if copies: folders = folders + [f for t, f, p in LABELS if t in tags]
+
+        for folder in folders:
+            uid = uid + 1
+            fmd5 = hashlib.md5(folder.encode('utf-8')).hexdigest()
+            name = '%d_%d.%d.bench,U=%d,FMD5=%s:2,%s' % (1500000000 + n, n, 0, uid, fmd5, flags)
+            path = os.path.join(maildir, folder, 'cur', name)
+            with open(path, 'wb') as fd:
+                fd.write(content)
+            mtime = calendar.timegm(date.timetuple())
+            os.utime(path, (mtime, mtime))
+            nfiles = nfiles + 1
+
+        thread.append(msgid)
+
+    return nfiles
+
+
+
+# Indexing
+# ----------------------------------------------
+
+_header_re = re.compile(r'^([A-Za-z-]+):[ \t]*(.*(?:\n[ \t].*)*)$', flags=re.MULTILINE)
+
+
+def _read_headers(path):
+    with open(path, 'rb') as fd:
+        head = fd.read(64*1024)
+    end = head.find(b'\n\n')
+    if end != -1: head = head[:end]
+    text = head.decode('utf-8', errors='replace')
+    return {m.group(1).lower(): re.sub(r'\n[ \t]+', ' ', m.group(2)).strip()
+            for m in _header_re.finditer(text)}
+
+
+def _folder_files(maildir):
+    for dirpath, dirnames, filenames in os.walk(maildir):
+        dirnames[:] = sorted([d for d in dirnames if d[0] != '.'])
+        if not os.path.basename(dirpath) in ['cur', 'new']: continue
+        folder = '/' + os.path.relpath(os.path.dirname(dirpath), maildir)
+        for f in sorted(filenames):
+            if f[0] != '.': yield folder, os.path.join(dirpath, f)
+
+
+def scan(maildir, muhome):
+    """Indexes maildir into the fake mu database in muhome. Returns the number
+    of messages."""
+    records = []
+    for folder, path in _folder_files(maildir):
+        h = _read_headers(path)
+        st = os.stat(path)
+
+        m = re.search(':2,([A-Za-z]*)$', path)
+        flags = [_flag_letters[c] for c in (m.group(1) if m else '') if c in _flag_letters]
+
+        date = email.utils.parsedate_tz(h.get('date', ''))
+        if date: date = email.utils.mktime_tz(date)
+        else:    date = int(st.st_mtime)
+
+        refs = h.get('references', '').split()
+        records.append({'path': path,
+                        'maildir': folder,
+                        'message-id': h.get('message-id', '').strip('<>'),
+                        'refs': [r.strip('<>') for r in refs],
+                        'subject': h.get('subject', ''),
+                        'from': email.utils.getaddresses([h.get('from', '')]),
+                        'to': email.utils.getaddresses([h.get('to', '')]),
+                        'date': date,
+                        'size': st.st_size,
+                        'mtime': st.st_mtime,
+                        'flags': flags,
+                        'tags': [t.strip() for t in h.get('x-keywords', '').split(',') if t.strip()]})
+
+    # thread paths, as mu does: one hex index per level
+    records.sort(key=lambda r: (r['date'], r['path']))
+    children = {}
+    paths = {}
+    roots = 0
+    for r in records:
+        mid = r['message-id']
+        if mid in paths:
+            r['thread'] = paths[mid]
+            continue
+
+        parent = r['refs'][-1] if len(r['refs']) > 0 else None
+        if parent in paths:
+            num = children.get(parent, 0)
+            children[parent] = num + 1
+            paths[mid] = '%s:%x' % (paths[parent], num)
+        else:
+            paths[mid] = '%x' % roots
+            roots = roots + 1
+        r['thread'] = paths[mid]
+
+    tmppath = os.path.join(muhome, DBNAME + '.tmp')
+    with open(tmppath, 'w') as fd:
+        for docid, r in enumerate(records, 1):
+            r['docid'] = docid
+            fd.write(json.dumps(r, ensure_ascii=False) + '\n')
+    os.rename(tmppath, os.path.join(muhome, DBNAME))
+    return len(records)
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] <maildir> <muhome>")
+    parser.add_option("--count", action="store", type="int", default=1000, dest="count",
+                      help="Number of distinct messages")
+    parser.add_option("--seed", action="store", type="int", default=0, dest="seed",
+                      help="Random seed")
+    parser.add_option("--size-median", action="store", type="int", default=4000, dest="size_median",
+                      help="Median body size in bytes")
+    parser.add_option("--size-sigma", action="store", type="float", default=1.0, dest="size_sigma",
+                      help="Spread of the log-normal body size distribution")
+    parser.add_option("--thread-depth", action="store", type="int", default=4, dest="thread_depth",
+                      help="Maximum number of messages in a thread")
+    parser.add_option("--no-copies", action="store_false", default=True, dest="copies",
+                      help="Do not write gmail-style copies in label folders")
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("need a maildir and a muhome")
+
+    maildir, muhome = args
+    os.makedirs(muhome, exist_ok=True)
+    nfiles = generate(maildir, count=opts.count, seed=opts.seed, size_median=opts.size_median,
+                      size_sigma=opts.size_sigma, thread_depth=opts.thread_depth, copies=opts.copies)
+    scan(maildir, muhome)
+    print(json.dumps({'messages': opts.count, 'files': nfiles}))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
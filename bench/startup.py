@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Startup latency benchmark. Runs python -X importtime on a few mutag entry
+# points, and fails if the import time goes over budget, or if a module that
+# should be loaded lazily shows up.
+#
+#   python3 bench/startup.py [--budget-ms N] [--runs N]
+
+import os
+import re
+import sys
+import json
+import subprocess
+
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# entry point -> (python code to run, modules that must not be imported)
+SCENARIOS = {
+    'version': ("import runpy, sys; sys.argv = ['mutag', '--version']; "
+                "runpy.run_path('mutag.py', run_name='__main__')",
+                ['pyparsing', 'curses', 'email.parser', 'mutag.server']),
+
+    'count':   ("import mutag.mutag, mutag.archui",
+                ['pyparsing', 'curses', 'email.parser']),
+
+    'client':  ("import mutag.client",
+                ['mutag.mutag', 'pyparsing', 'curses', 'email.parser']),
+}
+
+_line_re = re.compile(r'^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|(\s*)(\S+)\s*$')
+
+
+def measure(code):
+    """Returns the total import time in microseconds and the imported modules"""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          cwd=ROOT, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+
+    total = 0
+    modules = set()
+    for line in proc.stderr.splitlines():
+        m = _line_re.match(line)
+        if not m: continue
+        modules.add(m.group(4))
+        # only top level imports, the cumulative time includes the nested ones
+        if len(m.group(3)) == 1:
+            total = total + int(m.group(2))
+    return total, modules
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--budget-ms", action="store", type="float", default=60.0, dest="budget",
+                      help="Maximum import time for any scenario, in milliseconds")
+    parser.add_option("--runs", action="store", type="int", default=5, dest="runs",
+                      help="Number of runs. The best one is reported")
+    (opts, args) = parser.parse_args()
+
+    failed = False
+    results = {}
+    for name, (code, forbidden) in sorted(SCENARIOS.items()):
+        best = None
+        for i in range(opts.runs):
+            total, modules = measure(code)
+            if best == None or total < best: best = total
+
+        loaded = sorted([m for m in forbidden if m in modules])
+        ok = best <= 1000*opts.budget and len(loaded) == 0
+        failed = failed or not ok
+
+        results[name] = {'import_ms': best / 1000.0,
+                         'budget_ms': opts.budget,
+                         'unexpected_modules': loaded,
+                         'ok': ok}
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Command benchmarks. Generates a synthetic maildir, puts the fake mu in the
+# PATH, and runs mutag commands against it in a scratch HOME. For each
+# scenario reports wall and cpu time, the number of messages in scope, the
+# throughput and the peak RSS, as json.
+#
+# Scenarios run in order on the same maildir, and the ones that write are
+# followed by a reindex that is not timed.
+#
+# With --git the maildir is put under git and the scenarios that write also
+# commit, with -c. Expire then covers messages that are flagged, and so
+# renamed, and then removed from their folder in the same run.
+#
+#   python3 bench/suite.py [--count N] [--scenarios count,list,...] [--git] [--keep]
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+from optparse import OptionParser
+
+import maildir as md
+import fakemu
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH = os.path.join(ROOT, 'bench')
+
+# name -> (mutag arguments, query giving the messages in scope, writes)
+SCENARIOS = [
+    ('count',    (['-C', '-q', 'tag:lists'],          ['tag:lists'],          False)),
+    ('list',     (['-L', '-q', 'maildir:/INBOX'],     ['maildir:/INBOX'],     False)),
+    ('update',   (['-u'],                             None,                   False)),
+    ('tag',      (['-T', '-q', 'tag:work', '+bench'], ['tag:work'],           True)),
+    ('autotag',  (['-A'],                             [],                     True)),
+    ('expire',   (['-E'],                             'expire',               True)),
+    ('trash',    (['--empty-trash'],                  'trash',                True)),
+]
+
+_conf = """[mutag]
+defaultprofile = bench
+color = no
+
+[profile bench]
+muhome = {muhome}
+maildir = {maildir}
+trashtag = \\Trash
+trashfolder = Trash
+gmailfolders = All Mail
+expiredays = 365
+lastmtime = {home}/mutag_mtime
+tagrules = {rules}
+"""
+
+
+def setup(workdir, opts):
+    """Writes the maildir, the mu database, the config and the mu wrapper.
+    Returns the environment to run mutag in."""
+    home = os.path.join(workdir, 'home')
+    maildir = os.path.join(workdir, 'mail')
+    muhome = os.path.join(workdir, 'mu')
+    bindir = os.path.join(workdir, 'bin')
+    for d in [home, maildir, muhome, bindir, os.path.join(home, '.config', 'mutag')]:
+        os.makedirs(d, exist_ok=True)
+
+    t0 = time.time()
+    nfiles = md.generate(maildir, count=opts.count, seed=opts.seed, size_median=opts.size_median,
+                         size_sigma=opts.size_sigma, thread_depth=opts.thread_depth,
+                         copies=opts.copies)
+    md.scan(maildir, muhome)
+    if opts.git:
+        for args in [['init', '-q'], ['config', 'user.name', 'bench'],
+                     ['config', 'user.email', 'bench@localhost'],
+                     ['add', '-A'], ['commit', '-q', '-m', 'bench maildir']]:
+            subprocess.check_call(['git'] + args, cwd=maildir, stdout=subprocess.DEVNULL)
+    elapsed = time.time() - t0
+
+    with open(os.path.join(home, '.config', 'mutag', 'mutag.conf'), 'w') as fd:
+        fd.write(_conf.format(muhome=muhome, maildir=maildir, home=home,
+                              rules=os.path.join(BENCH, 'tagrules.py')))
+
+    mu = os.path.join(bindir, 'mu')
+    with open(mu, 'w') as fd:
+        fd.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(BENCH, 'fakemu.py')))
+    os.chmod(mu, 0o755)
+
+    env = dict(os.environ)
+    env['HOME'] = home
+    env['PATH'] = bindir + os.pathsep + env.get('PATH', '')
+    env['PYTHONPATH'] = ROOT
+    env = {'env': env, 'maildir': maildir, 'muhome': muhome}
+
+    return env, {'messages': opts.count, 'files': nfiles, 'setup_s': elapsed}
+
+
+def in_scope(ctx, scope):
+    """Number of messages a scenario works on"""
+    if scope == None:
+        return sum([1 for f, p in md._folder_files(ctx['maildir'])])
+    elif scope == 'trash':
+        return sum([1 for f, p in md._folder_files(ctx['maildir']) if f == '/' + md.TRASH])
+
+    db = fakemu.load_db(ctx['muhome'])
+    if scope == 'expire':
+        # same cut as the bench tag rules, with expiredays = 365
+        cut = time.time() - 365*86400
+        return sum([1 for r in db if r['date'] < cut])
+
+    match = fakemu.compile_query(scope)
+    return sum([1 for r in db if match(r)])
+
+
+def run_scenario(ctx, args):
+    """Runs mutag with args. Returns wall time, cpu time, peak RSS in kB and
+    the exit status."""
+    cmd = [sys.executable, os.path.join(ROOT, 'mutag.py'), '--silent'] + args
+    t0 = time.time()
+    proc = subprocess.Popen(cmd, env=ctx['env'], cwd=ROOT, stdout=subprocess.DEVNULL)
+    pid, status, ru = os.wait4(proc.pid, 0)
+    wall = time.time() - t0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    # the rusage of the child includes the mu processes it waited for, so the
+    # cpu time counts them, and the peak RSS is the largest of the lot
+    return wall, ru.ru_utime + ru.ru_stime, ru.ru_maxrss, proc.returncode
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--count", action="store", type="int", default=2000, dest="count",
+                      help="Number of distinct messages in the maildir")
+    parser.add_option("--seed", action="store", type="int", default=0, dest="seed",
+                      help="Random seed for the maildir")
+    parser.add_option("--size-median", action="store", type="int", default=4000, dest="size_median",
+                      help="Median body size in bytes")
+    parser.add_option("--size-sigma", action="store", type="float", default=1.0, dest="size_sigma",
+                      help="Spread of the log-normal body size distribution")
+    parser.add_option("--thread-depth", action="store", type="int", default=4, dest="thread_depth",
+                      help="Maximum number of messages in a thread")
+    parser.add_option("--no-copies", action="store_false", default=True, dest="copies",
+                      help="Do not write gmail-style copies in label folders")
+    parser.add_option("--scenarios", action="store", type="string", default=None, dest="scenarios",
+                      help="Comma separated list of scenarios to run")
+    parser.add_option("--workdir", action="store", type="string", default=None, dest="workdir",
+                      help="Where to build the maildir. A temporary directory by default")
+    parser.add_option("--git", action="store_true", default=False, dest="git",
+                      help="Put the maildir under git, and commit after the scenarios that write")
+    parser.add_option("--keep", action="store_true", default=False, dest="keep",
+                      help="Keep the working directory")
+    (opts, args) = parser.parse_args()
+
+    names = [n for n, s in SCENARIOS]
+    if opts.scenarios:
+        selected = [s.strip() for s in opts.scenarios.split(',')]
+        for s in selected:
+            if not s in names: parser.error("unknown scenario '%s'" % s)
+    else:
+        selected = names
+
+    if opts.workdir:
+        workdir = os.path.abspath(os.path.expanduser(opts.workdir))
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        workdir = tempfile.mkdtemp(prefix='mutag-bench-')
+
+    failed = False
+    try:
+        ctx, info = setup(workdir, opts)
+        results = {'maildir': info, 'scenarios': {}}
+
+        for name, (args, scope, writes) in SCENARIOS:
+            if not name in selected: continue
+
+            if writes and opts.git: args = args + ['-c']
+
+            items = in_scope(ctx, scope)
+            wall, cpu, rss, status = run_scenario(ctx, args)
+            failed = failed or status != 0
+
+            results['scenarios'][name] = {'args': args,
+                                          'items': items,
+                                          'wall_s': round(wall, 4),
+                                          'cpu_s': round(cpu, 4),
+                                          'items_per_s': round(items / wall, 1) if wall > 0 else None,
+                                          'peak_rss_kb': rss,
+                                          'status': status}
+
+            if writes: md.scan(ctx['maildir'], ctx['muhome'])
+
+    finally:
+        if not opts.keep: shutil.rmtree(workdir, ignore_errors=True)
+
+    if opts.keep: results['workdir'] = workdir
+    print(json.dumps(results, indent=2, sort_keys=True))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tag rules for the benchmarks. They look at addresses and thread data, like
+# real rules do, and retag a fraction of the synthetic maildir.
+
+class TagRules(object):
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.maildir = path
+        self.noexpire_tag = 'noexpire'
+
+        self.rules = [
+          ('lists',    self._tags_lists),
+          ('people',   self._tags_people),
+          ('thread',   self._tags_thread),
+          ]
+
+
+    def get_tags(self, msg):
+        tags = set(msg['tags'])
+        for rname, rfunc in self.rules:
+            rfunc(msg, tags)
+        return tags
+
+
+    def expire_query(self, date):
+        return 'date:..%s' % date.strftime('%Y%m%d')
+
+
+    def expire(self, msg):
+        return 'lists' in msg['tags'] and not 'flagged' in msg['flags']
+
+
+    def _tags_lists(self, msg, tags):
+        for e in msg['emails']:
+            if e.endswith('@lists.example.org'):
+                tags.add('list')
+                tags.add('list-' + e.split('@')[0])
+
+
+    def _tags_people(self, msg, tags):
+        for e in msg['emails']:
+            if e in ['person1@example.com', 'person2@example.com', 'person3@example.com']:
+                tags.add('boss')
+
+
+    def _tags_thread(self, msg, tags):
+        if 'boss' in msg.get('thread-tags', set()) or \
+           'person1@example.com' in msg.get('thread-emails', set()):
+            tags.add('important')
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -18,8 +18,12 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import io
 import os
 import sys
+import copy
+import json
+import shlex
 
 from optparse import OptionParser, OptionGroup
 from configparser import RawConfigParser
@@ -50,6 +54,30 @@ def get_config_int(conf, name, key, default=0):
         return default
 
 
+def get_config_float(conf, name, key, default=0.0):
+    if conf.has_option('profile %s' % name, key):
+        return float(conf.get('profile %s' % name, key))
+    else:
+        return default
+
+
+def get_config_bool(conf, name, key, default=False):
+    if conf.has_option('profile %s' % name, key):
+        return conf.getboolean('profile %s' % name, key)
+    else:
+        return default
+
+
+def get_profile_names(conf, opts):
+    """Returns the names of the profiles selected on the command line"""
+    if opts.all_profiles:
+        return [sec[len('profile '):] for sec in conf.sections() if sec.startswith('profile ')]
+    elif opts.profile:
+        return [p.strip() for p in opts.profile.split(',') if len(p.strip()) > 0]
+    else:
+        return [conf.get('mutag', 'defaultprofile')]
+
+
 def get_profile(conf, opts):
 
     if opts.profile: name = opts.profile
@@ -58,6 +86,7 @@ def get_profile(conf, opts):
     # TODO: catch nonexistent profile
 
     prof = {}
+    prof['name'] = name
 
     prof['muhome'] = get_config_path(conf, name, 'muhome')
     prof['maildir'] = get_config_path(conf, name, 'maildir')
@@ -78,45 +107,223 @@ def get_profile(conf, opts):
     prof['lastmtime'] = get_config_path(conf, name, 'lastmtime')
     prof['tagrules'] = get_config_path(conf, name, 'tagrules')
 
+    prof['linkcopies'] = get_config_bool(conf, name, 'linkcopies', False)
+
+    prof['writebehind'] = get_config_bool(conf, name, 'writebehind', False)
+    prof['journal'] = get_config_path(conf, name, 'journal')
+    prof['journalflush'] = get_config_int(conf, name, 'journalflush', 0)
+
+    prof['pagesize'] = get_config_int(conf, name, 'pagesize', 0)
+    prof['prefetch'] = get_config_bool(conf, name, 'prefetch', False)
+    prof['mutimeout'] = get_config_float(conf, name, 'mutimeout', 0.0)
+
+    prof['checkpoint'] = get_config_path(conf, name, 'checkpoint')
+    prof['checkpointinterval'] = get_config_int(conf, name, 'checkpointinterval', 30)
+
+    prof['tagindex'] = get_config_path(conf, name, 'tagindex')
+    prof['headercache'] = get_config_path(conf, name, 'headercache')
+    prof['headercachesize'] = get_config_int(conf, name, 'headercachesize', 100000)
+    prof['contentcache'] = get_config_path(conf, name, 'contentcache')
+    prof['contentcachesize'] = get_config_int(conf, name, 'contentcachesize', 1000)
+    prof['contentlimit'] = get_config_int(conf, name, 'contentlimit', 64*1024)
+
+    prof['planworkers'] = get_config_int(conf, name, 'planworkers', 4)
+
+    prof['background'] = get_config_bool(conf, name, 'background', False)
+    prof['backgroundnice'] = get_config_int(conf, name, 'backgroundnice', 10)
+    prof['backgroundwrites'] = get_config_float(conf, name, 'backgroundwrites', 50.0)
+    prof['backgroundbytes'] = get_config_float(conf, name, 'backgroundbytes', 4*1024*1024)
+    prof['backgroundload'] = get_config_float(conf, name, 'backgroundload', float(os.cpu_count() or 1))
+
+    prof['metrics'] = get_config_path(conf, name, 'metrics')
+    prof['metricsformat'] = get_config_string(conf, name, 'metricsformat')
+
+    prof['gituntrackedcache'] = get_config_bool(conf, name, 'gituntrackedcache', False)
+    prof['gitfsmonitor'] = get_config_string(conf, name, 'gitfsmonitor')
+
+    if opts.defer: prof['writebehind'] = True
+    if opts.pagesize != None: prof['pagesize'] = opts.pagesize
+    if opts.prefetch: prof['prefetch'] = True
+    if opts.background: prof['background'] = True
+    if opts.metrics: prof['metrics'] = os.path.expanduser(opts.metrics)
+
     if opts.muhome: prof['muhome'] = os.path.expanduser(opts.muhome)
     if opts.muhome: prof['maildir'] = os.path.expanduser(opts.maildir)
 
     return prof
 
 
-def eval_command(opts, args):
+def load_config(cache=None):
+    path = os.path.expanduser('~/.config/mutag/mutag.conf')
+    try:    mtime = os.stat(path).st_mtime
+    except OSError: mtime = None
+
+    if cache != None and 'conf' in cache and cache['conf'][0] == mtime:
+        return cache['conf'][1]
+
     conf = RawConfigParser(defaults={})
-    conf.read([os.path.expanduser('~/.config/mutag/mutag.conf')])
+    conf.read([path])
+    if cache != None: cache['conf'] = (mtime, conf)
+    return conf
+
+
+def get_mutag(prof, cache=None):
+    if cache == None:
+        return Mutag(prof = prof)
+
+    key = repr(sorted(prof.items()))
+    if not key in cache.setdefault('mutag', {}):
+        cache['mutag'][key] = Mutag(prof = prof)
+    return cache['mutag'][key]
+
+
+def command_fields(cmd, opts):
+    """Message fields consumed by a command. None means the whole record."""
+    if cmd == 'filename':                      return ['path']
+    elif cmd == 'print' and not opts.mbox:     return ['path']
+    else:                                      return None
+
+
+def print_message(msg, fmt, outbound=False):
+    if fmt == 'jsonl':
+        # machine readable, keep it away from the color handling
+        sys.stdout.write(msg.tostring(fmt=fmt, outbound=outbound) + '\n')
+    else:
+        ui.print_color(msg.tostring(fmt=fmt, outbound=outbound))
+
+
+def print_filename(msg, fmt, null=False):
+    if null:            sys.stdout.write(msg['path'] + '\0')
+    elif fmt == 'jsonl': sys.stdout.write(json.dumps({'path': msg['path']}, ensure_ascii=False) + '\n')
+    else:               sys.stdout.write(msg['path'] + '\n')
+
+
+def print_timings(stats):
+    ui.print_color("#W%-14s %10s %10s %10s#t" % ('phase', 'wall (s)', 'cpu (s)', 'items'), file=sys.stderr)
+    for name, wall, cpu, count in stats.report():
+        ui.print_color("%-14s %10.3f %10.3f %10d" % (name, wall, cpu, count), file=sys.stderr)
+
+
+
+def eval_batch(mutag, opts, fd):
+    """Runs the operations in fd, one mutag command line per line. Tag and flag
+    changes are merged per file and written once at the end."""
+    staged = {}
+    for lineno, line in enumerate(fd, 1):
+        line = line.strip()
+        if len(line) == 0 or line[0] == '#': continue
+
+        try:
+            (bopts, bargs) = parser.parse_args(shlex.split(line))
+        except (SystemExit, ValueError):
+            ui.print_error("line %d: could not parse '%s'" % (lineno, line))
+            continue
+
+        if bopts.query:
+            bopts.query = bopts.query.replace('\\', '\\\\')
+
+        silent = opts.silent or bopts.silent
+
+        try:
+            if bopts.cmd == 'count':
+                print(mutag.count(bopts.query, modified_only=bopts.modified, use_index=True))
+                continue
+
+            L = mutag.query(bopts.query, path = bopts.path, modified_only=bopts.modified,
+                            related=False, fields=command_fields(bopts.cmd, bopts))
+
+            if bopts.cmd == 'tag':
+                num = mutag.stage_tags(L, bargs, staged, silent=silent)
+                print(num)
+
+            elif bopts.cmd == 'flag':
+                num = mutag.stage_flags(L, bargs, staged, silent=silent)
+                print(num)
+
+            elif bopts.cmd == 'list':
+                for msg in L:
+                    # show the pending state of the message
+                    if msg['path'] in staged:
+                        msg['tags'] = set(staged[msg['path']]['tags'])
+                        msg['flags'] = set(staged[msg['path']]['flags'])
+                    print_message(msg, bopts.format)
+
+            elif bopts.cmd == 'filename':
+                for msg in L:
+                    print_filename(msg, bopts.format, null=bopts.null)
+
+            else:
+                ui.print_error("line %d: command not supported in batch mode" % lineno)
+
+        except MutagError as err:
+            ui.print_error("line %d: %s" % (lineno, str(err)))
+
+    num = mutag.write_staged(staged, dryrun=opts.dryrun, silent=opts.silent)
+    if not opts.silent:
+        ui.print_color("Batch changed #G%d#t files." % num, file=sys.stderr)
+
+
+
+def eval_command(opts, args, cache=None):
+    conf = load_config(cache)
     ui.set_debug(opts.debug)
 
     ui.use_color(conf.getboolean("mutag", 'color'))
     # If the output is not a terminal, remove the colors
     if not sys.stdout.isatty(): ui.use_color(False)
 
+    # only status lines need to hit the terminal right away
+    ui.set_buffered(True)
+
     prof = get_profile(conf, opts)
-    mutag = Mutag(prof = prof)
+    mutag = get_mutag(prof, cache)
+
+    # a cached Mutag may still hold the plan of a command that failed, and
+    # would go on recording changes instead of writing them
+    mutag.plan = None
+
+    # a server would stay at low priority for good, so it does not renice
+    if prof['background'] and cache == None:
+        from mutag.throttle import lower_priority
+        lower_priority(prof['backgroundnice'])
+    mutag.stats.reset()
+    tstart = mutag.stats.start()
 
     # escape '\' in query so xapian understands us.
     if opts.query:
         opts.query = opts.query.replace('\\', '\\\\')
 
-    if opts.cmd == 'autotag':
-        mutag.autotag(query=opts.query, path=opts.path, modified_only=opts.modified, related=True, dryrun=opts.dryrun, silent=opts.silent)
+    if opts.plan:
+        if opts.batch or opts.apply_plan or not opts.cmd in ['autotag', 'tag', 'flag']:
+            raise MutagError("plans can only be made for autotag, tag and flag")
+        mutag.start_plan()
+
+    if opts.apply_plan:
+        mutag.apply_plan(os.path.expanduser(opts.apply_plan), dryrun=opts.dryrun, silent=opts.silent)
+
+    elif opts.batch:
+        if opts.batch == '-':
+            eval_batch(mutag, opts, sys.stdin)
+        else:
+            with open(os.path.expanduser(opts.batch), 'r') as fd:
+                eval_batch(mutag, opts, fd)
+
+    elif opts.cmd == 'autotag':
+        mutag.autotag(query=opts.query, path=opts.path, modified_only=opts.modified, related=True, dryrun=opts.dryrun, silent=opts.silent,
+                      resume=opts.resume)
 
     elif opts.cmd == 'expire':
-        mutag.expire(dryrun=opts.dryrun, silent=opts.silent)
+        mutag.expire(dryrun=opts.dryrun, silent=opts.silent, resume=opts.resume)
 
     elif opts.cmd in set(['autotag', 'expire']) and opts.index:
         mutag.index(dryrun=opts.dryrun, silent=opts.silent)
 
     elif opts.cmd == 'count':
-        num = mutag.count(opts.query, modified_only=opts.modified)
+        num = mutag.count(opts.query, modified_only=opts.modified, use_index=True)
         print(num)
 
     elif opts.cmd == 'dedup':
-        # TODO
-        print("dedup not implemented")
-        sys.exit()
+        mutag.dedup(dryrun=opts.dryrun, silent=opts.silent, hardlink=opts.dedup_link)
 
     elif opts.cmd == 'tag':
         L = mutag.query(opts.query, path = opts.path,
@@ -133,27 +340,42 @@ def eval_command(opts, args):
             mutag.index(dryrun=opts.dryrun, silent=opts.silent)
 
     elif opts.cmd == 'list':
-        L = mutag.query(opts.query, path = opts.path,
-                        modified_only=opts.modified, related=False)
+        L = mutag.query(opts.query, path = opts.path, modified_only=opts.modified,
+                        related=False, use_index=True)
         for msg in L:
-            ui.print_color(msg.tostring(fmt=opts.format))
+            print_message(msg, opts.format)
 
     elif opts.cmd == 'queue':
         L = mutag.queue()
         for msg in L:
-            ui.print_color(msg.tostring(fmt=opts.format, outbound=True))
+            print_message(msg, opts.format, outbound=True)
 
     elif opts.cmd == 'print':
-        L = mutag.query(opts.query, path = opts.path,
-                        modified_only=opts.modified, related=False)
+        L = mutag.query(opts.query, path = opts.path, modified_only=opts.modified,
+                        related=False, fields=command_fields(opts.cmd, opts))
+        sys.stdout.flush()
+        out = sys.stdout.buffer
         for msg in L:
-            print(msg.raw())
+            if opts.mbox: msg.write_mbox(out)
+            else:         msg.write_raw(out)
+        out.flush()
 
     elif opts.cmd == 'filename':
-        L = mutag.query(opts.query, path = opts.path,
-                        modified_only=opts.modified, related=False)
+        L = mutag.query(opts.query, path = opts.path, modified_only=opts.modified,
+                        related=False, fields=command_fields(opts.cmd, opts))
         for msg in L:
-            print(msg['path'])
+            print_filename(msg, opts.format, null=opts.null)
+
+    elif opts.cmd == 'histogram':
+        for tag, num in mutag.tag_histogram():
+            if opts.format == 'jsonl': print(json.dumps({'tag': tag, 'count': num}, ensure_ascii=False))
+            else:                      ui.print_color('#G%8d#t %s' % (num, tag))
+
+    elif opts.cmd == 'tagindex':
+        mutag.update_tagindex(dryrun=opts.dryrun, silent=opts.silent)
+
+    elif opts.cmd == 'flush':
+        mutag.flush_journal(dryrun=opts.dryrun, silent=opts.silent)
 
     elif opts.cmd == 'rebuild':
         mutag.rebuild(dryrun=opts.dryrun, silent=opts.silent)
@@ -173,6 +395,116 @@ def eval_command(opts, args):
     if opts.commit:
         mutag.commit(dryrun=opts.dryrun, silent=opts.silent)
 
+    if opts.plan:
+        num = mutag.save_plan(os.path.expanduser(opts.plan))
+        ui.print_color("Wrote a plan for #G%d#t files to #B%s#t" % (num, opts.plan))
+
+    mutag.finish()
+
+    mutag.stats.stop('total', tstart, 0)
+    if opts.timings:
+        print_timings(mutag.stats)
+
+    if prof['metrics']:
+        from mutag.stats import write_metrics
+        labels = {'profile': prof['name'], 'command': opts.cmd or 'none'}
+        write_metrics([(mutag.stats.todict(), labels)], prof['metrics'], fmt=prof['metricsformat'])
+
+    return mutag
+
+
+
+def _profile_worker(opts, args, name, outpath, stdin=None):
+    """Runs the command on a single profile, in a worker process, with the
+    output going to outpath. Workers have no stdin, a batch read from it by the
+    parent is passed in stdin. Returns the exit status and the stats of the
+    run."""
+    opts = copy.copy(opts)
+    opts.profile = name
+    opts.metrics = None        # the parent writes them for all profiles
+    if stdin != None: sys.stdin = io.StringIO(stdin)
+
+    status = 0
+    stats = None
+    stdout, stderr = sys.stdout, sys.stderr
+    with open(outpath, 'w') as out:
+        sys.stdout = sys.stderr = out
+        try:
+            mutag = eval_command(opts, args)
+            stats = mutag.stats.todict()
+
+        except MutagError as err:
+            ui.print_error(str(err))
+            status = 1
+
+        except Exception as err:
+            # the other profiles go on
+            ui.print_error("%s: %s" % (err.__class__.__name__, str(err)))
+            status = 1
+
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    return status, stats
+
+
+
+def eval_profiles(opts, args, names, conf):
+    """Runs the command on each of the profiles in names, each in its own
+    worker process. The output of each profile is printed as a block, in the
+    order of names."""
+    import shutil
+    import tempfile
+    import multiprocessing
+
+    if opts.jobs:                         jobs = opts.jobs
+    elif conf.has_option('mutag', 'jobs'): jobs = conf.getint('mutag', 'jobs')
+    else:                                 jobs = len(names)
+    jobs = max(1, min(jobs, len(names)))
+
+    # the workers would all write the same plan file
+    if opts.plan:
+        raise MutagError("--plan only works on a single profile")
+
+    # multiprocessing gives the workers /dev/null as stdin
+    stdin = None
+    if opts.batch == '-': stdin = sys.stdin.read()
+
+    ui.use_color(conf.getboolean("mutag", 'color'))
+    if not sys.stdout.isatty(): ui.use_color(False)
+
+    status = 0
+    runs = []
+    tmpdir = tempfile.mkdtemp(prefix='mutag-')
+    try:
+        # fork, so workers need not import mutag.py again. A fresh worker per
+        # profile, as tag rules and ui settings are process globals.
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(processes=jobs, maxtasksperchild=1) as pool:
+            pending = []
+            for i, name in enumerate(names):
+                outpath = os.path.join(tmpdir, '%d.out' % i)
+                pending.append((name, outpath, pool.apply_async(_profile_worker, (opts, args, name, outpath, stdin))))
+
+            for name, outpath, res in pending:
+                st, stats = res.get()
+                ui.print_color("#B==> profile %s#t" % name)
+                with open(outpath, 'r') as fd:
+                    sys.stdout.write(fd.read())
+                sys.stdout.flush()
+
+                status = max(status, st)
+                if stats: runs.append((stats, {'profile': name, 'command': opts.cmd or 'none'}))
+
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if opts.metrics:
+        from mutag.stats import write_metrics
+        write_metrics(runs, os.path.expanduser(opts.metrics))
+
+    return status
+
 
 
 
@@ -215,6 +547,21 @@ parser.add_option("-P", "--print", action="store_const", const="print", default=
 parser.add_option("-F", "--filename", action="store_const", const="filename", default=None, dest="cmd",
                   help="Print the filenames")
 
+parser.add_option("--batch", action="store", type="string", default=None, dest="batch",
+                  help="Run the commands in the given file, one per line. Use - for stdin")
+
+parser.add_option("--apply-plan", action="store", type="string", default=None, dest="apply_plan",
+                  help="Apply the tag and flag changes in a plan file")
+
+parser.add_option("--histogram", action="store_const", const="histogram", default=None, dest="cmd",
+                  help="Print the number of messages with each tag, from the tag index")
+
+parser.add_option("--update-tagindex", action="store_const", const="tagindex", default=None, dest="cmd",
+                  help="Update the tag index from the maildir")
+
+parser.add_option("--flush", action="store_const", const="flush", default=None, dest="cmd",
+                  help="Write the changes recorded in the write-behind journal")
+
 parser.add_option("--rebuild", action="store_const", const="rebuild", default=None, dest="cmd",
                   help="rebuilds the entire database and quits")
 
@@ -237,10 +584,28 @@ parser.add_option("-t", "--target", action="store", type="string", default=None,
 
 # Options
 parser.add_option("-p", "--profile", action="store", type="string", default=None, dest="profile",
-                  help="Select a configuration profile")
+                  help="Select a configuration profile, or several separated by commas")
+
+parser.add_option("--all-profiles", action="store_true", default=False, dest="all_profiles",
+                  help="Run on all configured profiles")
+
+parser.add_option("-j", "--jobs", action="store", type="int", default=None, dest="jobs",
+                  help="Number of profiles processed at once")
 
 parser.add_option("-f", "--format", action="store", type="string", default='compact', dest="format",
-                  help="Format to print output")
+                  help="Format to print output: compact, raw or jsonl")
+
+parser.add_option("--plan", action="store", type="string", default=None, dest="plan",
+                  help="Write the changes of autotag, tag or flag to a plan file instead of applying them")
+
+parser.add_option("--dedup-link", action="store_true", default=False, dest="dedup_link",
+                  help="Replace duplicates by hardlinks instead of removing them")
+
+parser.add_option("--mbox", action="store_true", default=False, dest="mbox",
+                  help="Print raw messages in mbox format")
+
+parser.add_option("-0", "--null", action="store_true", default=False, dest="null",
+                  help="Separate filenames with NUL characters instead of newlines")
 
 parser.add_option("-u", "--update", action="store_true", default=False, dest="update",
                   help="Update list of modification times for the files.")
@@ -252,6 +617,21 @@ parser.add_option("-c", "--commit", action="store_true", default=False, dest="co
                   help="Commit mail if stored in a git repo")
 
 
+parser.add_option("--page-size", action="store", type="int", default=None, dest="pagesize",
+                  help="Query mu in pages of this many messages. Queries with related messages, as in autotag and expire, are not paged")
+
+parser.add_option("--prefetch", action="store_true", default=False, dest="prefetch",
+                  help="Fetch the next page of results while processing the current one")
+
+parser.add_option("--background", action="store_true", default=False, dest="background",
+                  help="Run at low cpu and io priority, pacing writes and waiting while the system is loaded")
+
+parser.add_option("--resume", action="store_true", default=False, dest="resume",
+                  help="Resume an interrupted autotag or expire run")
+
+parser.add_option("--defer", action="store_true", default=False, dest="defer",
+                  help="Record tag and flag changes in the journal instead of writing them")
+
 parser.add_option("-s", "--silent", action="store_true", default=False, dest="silent",
                   help="Runs silently.")
 
@@ -270,28 +650,106 @@ parser.add_option("--version", action="store_true", default=False, dest="version
 parser.add_option("--debug", action="store_true", default=False, dest="debug",
                   help="Print debug information")
 
+parser.add_option("--timings", action="store_true", default=False, dest="timings",
+                  help="Print the time spent in each phase of the command")
 
+parser.add_option("--metrics", action="store", type="string", default=None, dest="metrics",
+                  help="Write run metrics to FILE, as json if it ends in .json, in Prometheus textfile format otherwise")
+
+parser.add_option("--profile-out", action="store", type="string", default=None, dest="profile_out",
+                  help="Write a profile of the run to FILE")
+
+parser.add_option("--profile-kind", action="store", type="choice", choices=['cpu', 'memory'],
+                  default='cpu', dest="profile_kind",
+                  help="Kind of profile written by --profile-out: cpu (cProfile) or memory (tracemalloc)")
+
+parser.add_option("--server", action="store_true", default=False, dest="server",
+                  help="Run as a server listening on a unix socket, see mutagc")
+
+parser.add_option("--socket", action="store", type="string", default=None, dest="socket",
+                  help="Path to the server socket")
+
+
+
+def start_profile(kind):
+    if kind == 'memory':
+        import tracemalloc
+        tracemalloc.start(25)
+        return ('memory', None)
+    else:
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+        return ('cpu', prof)
+
+
+def stop_profile(profiler, path):
+    """Writes the profile to path. cpu profiles can be read with pstats,
+    memory ones with tracemalloc.Snapshot.load"""
+    kind, prof = profiler
+    if kind == 'memory':
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot.dump(path)
+    else:
+        prof.disable()
+        prof.dump_stats(path)
 
-(opts, args) = parser.parse_args()
 
-if opts.version:
-    print(__version__)
-    sys.exit(0)
 
+def run(argv, cache=None):
+    (opts, args) = parser.parse_args(argv)
+
+    if opts.version:
+        print(__version__)
+        return 0
+
+    if opts.server and cache != None:
+        ui.print_error("already running as a server")
+        return 1
+
+    profiler = None
+    if opts.profile_out:
+        profiler = start_profile(opts.profile_kind)
+
+    try:
+        names = get_profile_names(load_config(cache), opts)
+        if len(names) > 1:
+            return eval_profiles(opts, args, names, load_config(cache))
+
+        if len(names) == 1: opts.profile = names[0]
+        eval_command(opts, args, cache=cache)
+
+    except MutagError as err:
+        ui.print_error(str(err))
+        return 1
+
+    except EOFError:
+        print("")
+
+    finally:
+        if profiler: stop_profile(profiler, os.path.expanduser(opts.profile_out))
+
+    return 0
+
+
+
+(opts, args) = parser.parse_args()
 
 try:
-    eval_command(opts, args)
+    if opts.server:
+        from mutag.server import serve, default_socket_path
+        sockpath = opts.socket or os.environ.get('MUTAG_SOCKET', None) or default_socket_path()
+        cache = {}
+        ui.print_color("mutag server listening on #B%s#t" % sockpath)
+        serve(sockpath, lambda argv: run(argv, cache=cache))
 
-except MutagError as err:
-    ui.print_error(str(err))
-    sys.exit(1)
+    else:
+        sys.exit(run(sys.argv[1:]))
 
 except KeyboardInterrupt:
     print("")
     sys.exit()
 
-except EOFError:
-    print("")
-    sys.exit()
-
 # vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
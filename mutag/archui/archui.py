@@ -23,20 +23,8 @@ import os
 from collections import OrderedDict
 
 _cc = OrderedDict()
-
-# Load curses
-try:
-    import curses
-    curses.setupterm()
-
-    _numcolors = curses.tigetnum('colors')
-    _setfg = curses.tigetstr('setaf')
-    _setbg = curses.tigetstr('setab')
-    _bold  = curses.tigetstr('bold')
-    _reset = curses.tigetstr('sgr0')
-
-except:
-    _numcolors = 2
+_cc_ready = False     # whether _cc holds the terminal codes
+_cc_re = None         # compiled regex matching any of the codes in _cc
 
 
 # Encode in ascii
@@ -48,29 +36,58 @@ else:
         return str(n, encoding='ascii')
 
 
-if _numcolors >= 16:
-    for i, k in enumerate("krgybmcw"):
-        _cc[k.upper()] = _str(_reset + curses.tparm(_setfg, i))     # dark
-        _cc[k]         = _str(_reset + curses.tparm(_setfg, i + 8)) # light
-        _cc['*'+k]     = _str(_bold + curses.tparm(_setfg, i))      # bold
-        _cc['t']       = _str(_reset)
-        _cc['#']       = "#"
+def _init_colors():
+    """Query the terminal for its color codes. Deferred until the first colored
+    output, since curses.setupterm is slow and useless when not on a tty."""
+    global _cc_ready
+    _cc_ready = True
+
+    # Load curses
+    try:
+        import curses
+        curses.setupterm()
+
+        _numcolors = curses.tigetnum('colors')
+        _setfg = curses.tigetstr('setaf')
+        _setbg = curses.tigetstr('setab')
+        _bold  = curses.tigetstr('bold')
+        _reset = curses.tigetstr('sgr0')
+
+    except:
+        _numcolors = 2
+
+    if _numcolors >= 16:
+        for i, k in enumerate("krgybmcw"):
+            _cc[k.upper()] = _str(_reset + curses.tparm(_setfg, i))     # dark
+            _cc[k]         = _str(_reset + curses.tparm(_setfg, i + 8)) # light
+            _cc['*'+k]     = _str(_bold + curses.tparm(_setfg, i))      # bold
+            _cc['t']       = _str(_reset)
+            _cc['#']       = "#"
+
+    elif _numcolors >= 8:
+        for i, k in enumerate("krgybmcw"):
+            _cc[k.upper()] = _str(_reset + curses.tparm(_setfg, i)) # dark
+            _cc[k]         = _str(_bold + curses.tparm(_setfg, i))  # bold
+            _cc['*'+k]     = _str(_bold + curses.tparm(_setfg, i))  # bold
+            _cc['t']       = _str(_reset)
+            _cc['#']       = "#"
 
-elif _numcolors >= 8:
-    for i, k in enumerate("krgybmcw"):
-        _cc[k.upper()] = _str(_reset + curses.tparm(_setfg, i)) # dark
-        _cc[k]         = _str(_bold + curses.tparm(_setfg, i))  # bold
-        _cc['*'+k]     = _str(_bold + curses.tparm(_setfg, i))  # bold
-        _cc['t']       = _str(_reset)
-        _cc['#']       = "#"
+    else:
+        for i, k in enumerate("krgybmcw"):
+            _cc[k.upper()] = ""
+            _cc[k]         = ""
+            _cc['*'+k]     = ""
+            _cc['t']       = "\033[0m"
+            _cc['#']       = "#"
 
-else:
-    for i, k in enumerate("krgybmcw"):
-        _cc[k.upper()] = ""
-        _cc[k]         = ""
-        _cc['*'+k]     = ""
-        _cc['t']       = "\033[0m"
-        _cc['#']       = "#"
+
+# Placeholder codes, enough to strip the color marks without a terminal
+for i, k in enumerate("krgybmcw"):
+    _cc[k.upper()] = ""
+    _cc[k]         = ""
+    _cc['*'+k]     = ""
+    _cc['t']       = ""
+    _cc['#']       = "#"
 
 
 fc = {'done'  : '#G',
@@ -88,6 +105,7 @@ _maxwidth = 80        # max text width
 
 _debug      = 0       # debug flag
 _use_color  = True    # use colors flag
+_buffered   = False   # do not flush stdout after every write
 _last_status = ""     # remember text of last print_status
 
 
@@ -144,22 +162,47 @@ def strip_color(s):
     return re.sub(r'\x1b[^m]*m|\x1b[^B]*B', '', s)
 
 
+def _color_regex():
+    # longest codes first, so '#*b' wins over '#*'
+    global _cc_re
+    if _cc_re == None:
+        keys = sorted(_cc.keys(), key=len, reverse=True)
+        _cc_re = re.compile('#(' + '|'.join([re.escape(k) for k in keys]) + ')')
+    return _cc_re
+
+
+def _strip_code(m):
+    if m.group(1) == '#': return '#'
+    else:                 return ''
+
+
 def color(s):
     global _use_color
-    ret = s + '#t'
     if _use_color:
-        for k in _cc: ret = ret.replace('#'+k, _cc[k])
+        if not _cc_ready: _init_colors()
+        return _color_regex().sub(lambda m: _cc[m.group(1)], s + '#t')
+    elif '#' in s:
+        return _color_regex().sub(_strip_code, s)
     else:
-        for k in _cc: ret = ret.replace('#'+k, '')
-    return ret
+        return s
 
 
-def print_color(text, file=sys.stdout):
+def set_buffered(buf):
+    """When buffered, regular output to stdout is not flushed on every write.
+    Status and progress lines are always flushed."""
+    global _buffered
+    _buffered = buf
+
+
+def print_color(text, file=None):
     write_color(text + '\n', file)
 
-def write_color(text, file=sys.stdout):
-    file.write('%s' % color(text))
-    file.flush()
+def write_color(text, file=None, flush=False):
+    # resolve stdout at call time, so it can be redirected
+    if file == None: file = sys.stdout
+    file.write(color(text))
+    if flush or not _buffered or file != sys.stdout:
+        file.flush()
 
 def print_debug(t, level=1):
     global _debug
@@ -213,10 +256,10 @@ def print_status(text=None, flag=None, nl=None):
         if nl: fmt = fmt + '\n'
         else: fmt = fmt + '\r'
 
-        write_color(fmt.format(text, sta), file=sys.stdout)
+        write_color(fmt.format(text, sta), file=sys.stdout, flush=True)
     else:
         fmt = '\r%s:: #*w{0:<%s}\n' % (_mc, width)
-        write_color(fmt.format(text), file=sys.stdout)
+        write_color(fmt.format(text), file=sys.stdout, flush=True)
 
 
 def print_progress(text, r, nl=None):
@@ -242,6 +285,7 @@ def print_progress(text, r, nl=None):
 
 
 def ask_question_string(question):
+    sys.stdout.flush()
     write_color('%s ? #*w%s ' % (_mc, question), file=sys.stderr)
     return input()
 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Progress checkpoints for long running commands.
+#
+# The checkpoint file starts with a json header identifying the run (command,
+# query and tag rules fingerprint), followed by the keys of the messages that
+# are done, one per line. Keys are appended in batches, so keeping the
+# checkpoint costs an append every few seconds, not a rewrite of the whole
+# set.
+
+import os
+import json
+import time
+
+
+class Checkpoint(object):
+    def __init__(self, path, run, interval=30):
+        self.path = path
+        self.run = run              # dict identifying the run
+        self.interval = interval    # seconds between flushes
+        self.finished = set()       # keys done by a previous run
+        self._buffer = []
+        self._last = time.time()
+        self._fd = None
+
+
+    def start(self, resume=False):
+        """Opens the checkpoint. If resume is set and the checkpoint on disk was
+        written by the same kind of run, loads the keys already done. Otherwise
+        starts a new one. Returns the number of keys loaded."""
+        self.finished = set()
+        if resume:
+            try:
+                with open(self.path, 'r') as fd:
+                    header = json.loads(fd.readline())
+                    if header == self.run:
+                        # a torn last line is harmless, the key is redone
+                        self.finished = set([l.rstrip('\n') for l in fd if l.endswith('\n')])
+            except (OSError, ValueError):
+                pass
+
+        if len(self.finished) > 0:
+            self._fd = open(self.path, 'a')
+        else:
+            self._fd = open(self.path, 'w')
+            self._fd.write(json.dumps(self.run, sort_keys=True) + '\n')
+            self._fd.flush()
+
+        self._last = time.time()
+        return len(self.finished)
+
+
+    def done(self, key):
+        return key in self.finished
+
+
+    def due(self):
+        return time.time() - self._last >= self.interval
+
+
+    def mark(self, keys):
+        """Records keys as done. They hit the disk on the next flush."""
+        self._buffer.extend(keys)
+        if self.due(): self.flush()
+
+
+    def flush(self):
+        if self._fd != None and len(self._buffer) > 0:
+            self._fd.write(''.join([k + '\n' for k in self._buffer]))
+            self._fd.flush()
+        self._buffer = []
+        self._last = time.time()
+
+
+    def close(self):
+        """Flushes pending keys and closes the file, keeping it for a resume"""
+        self.flush()
+        if self._fd != None:
+            self._fd.close()
+            self._fd = None
+
+
+    def remove(self):
+        """The run completed, the checkpoint is no longer needed"""
+        self._buffer = []
+        self.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
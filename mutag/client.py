@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Thin client for a mutag server. Keep the imports light, the whole point is
+# not paying for mutag startup on every call.
+
+import os
+import sys
+import json
+import socket
+import struct
+
+from mutag.server import default_socket_path, read_frame
+
+
+def _reads_stdin(argv):
+    """Whether the command reads its stdin, which the server does not have"""
+    for i, a in enumerate(argv):
+        if a == '--batch=-': return True
+        if a == '--batch' and i + 1 < len(argv) and argv[i+1] == '-': return True
+    return False
+
+
+def run_client(argv, sockpath=None):
+    """Forwards argv to a running mutag server and streams back its output.
+    Returns the exit status of the command."""
+    if not sockpath:
+        sockpath = os.environ.get('MUTAG_SOCKET', None) or default_socket_path()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockpath)
+        req = {'argv': argv, 'cwd': os.getcwd(), 'isatty': sys.stdout.isatty()}
+        if _reads_stdin(argv): req['stdin'] = sys.stdin.read()
+        sock.sendall(json.dumps(req).encode('utf-8') + b'\n')
+
+        out = sys.stdout.buffer
+        err = sys.stderr.buffer
+        while True:
+            channel, payload = read_frame(sock)
+            if channel == b'o':
+                out.write(payload)
+            elif channel == b'e':
+                out.flush()
+                err.write(payload)
+                err.flush()
+            elif channel == b'x':
+                out.flush()
+                return struct.unpack('!i', payload)[0]
+
+    finally:
+        sock.close()
+
+
+def main():
+    try:
+        code = run_client(sys.argv[1:])
+    except (ConnectionRefusedError, FileNotFoundError):
+        sys.stderr.write("mutagc: no mutag server running. Start one with 'mutag --server'\n")
+        code = 2
+    except KeyboardInterrupt:
+        code = 130
+    sys.exit(code)
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The text of message bodies, for tag rules that look at content.
+#
+# Only the headers and the first limit bytes of the body are read and parsed.
+# The text is that of the text/plain parts, or of the text/html parts with the
+# markup stripped if there are no plain ones. Attachments are skipped, and
+# usually come after the text anyway.
+#
+# Extracted text is kept in an LRU cache for the run, and optionally in a
+# persistent store, which is a HeaderCache keyed by path and only valid while
+# the file keeps its mtime and size.
+
+import os
+import re
+
+from collections import OrderedDict
+
+DEFAULT_LIMIT = 64*1024
+
+
+_html_drop_re = re.compile(r'<(script|style)\b.*?</\1\s*>', flags=re.IGNORECASE|re.DOTALL)
+_html_tag_re = re.compile(r'<[^>]*>')
+_html_space_re = re.compile(r'[ \t\r\f\v]+')
+_html_lines_re = re.compile(r'\n\s*\n+')
+
+def html_to_text(html):
+    """A rough text rendering of html, good enough to match against"""
+    import html as htmllib
+    text = _html_drop_re.sub(' ', html)
+    text = _html_tag_re.sub(' ', text)
+    text = htmllib.unescape(text)
+    text = _html_space_re.sub(' ', text)
+    return _html_lines_re.sub('\n\n', text).strip()
+
+
+def _decode_part(part):
+    payload = part.get_payload(decode=True) or b''
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+
+def extract_text(path, limit=DEFAULT_LIMIT):
+    """Returns the text of the message at path, reading the headers and at
+    most limit bytes of the body. A limit of 0 reads the whole file."""
+    from email.parser import BytesFeedParser
+
+    parser = BytesFeedParser()
+    with open(path, 'rb') as fd:
+        for line in fd:
+            parser.feed(line)
+            if line in (b'\n', b'\r\n'): break
+        if limit > 0: parser.feed(fd.read(limit))
+        else:         parser.feed(fd.read())
+    msg = parser.close()
+
+    plain = []
+    html = []
+    for part in msg.walk():
+        if part.is_multipart(): continue
+        if part.get_content_disposition() == 'attachment': continue
+        ctype = part.get_content_type()
+        if ctype == 'text/plain':  plain.append(part)
+        elif ctype == 'text/html': html.append(part)
+
+    if len(plain) > 0:
+        return '\n'.join([_decode_part(p) for p in plain])
+    return '\n'.join([html_to_text(_decode_part(p)) for p in html])
+
+
+
+class ContentCache(object):
+    def __init__(self, limit=DEFAULT_LIMIT, maxsize=1000, path=None, persistsize=100000):
+        self.limit = limit
+        self.maxsize = maxsize      # entries kept in memory
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # path -> (stamp, limit, text)
+
+        self.store = None
+        if path:
+            from mutag.headercache import HeaderCache
+            self.store = HeaderCache(path, persistsize)
+
+
+    def _stamp(self, st):
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+    def get(self, path, limit=None):
+        """Returns the text of the message at path, extracting it only if there
+        is no cached text for the current version of the file"""
+        if limit == None: limit = self.limit
+        st = os.stat(path)
+        stamp = self._stamp(st)
+
+        ent = self._entries.get(path, None)
+        if ent != None and ent[0] == stamp and ent[1] == limit:
+            self._entries.move_to_end(path)
+            self.hits = self.hits + 1
+            return ent[2]
+
+        text = None
+        if self.store != None:
+            stored = self.store.get(path, st)
+            if stored != None and stored[0] == limit:
+                text = stored[1]
+
+        if text == None:
+            self.misses = self.misses + 1
+            text = extract_text(path, limit)
+            if self.store != None: self.store.put(path, st, (limit, text))
+        else:
+            self.hits = self.hits + 1
+
+        self._entries[path] = (stamp, limit, text)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return text
+
+
+    def save(self):
+        if self.store != None: self.store.save()
+
+
+
+# Used by Message.get_text. Mutag replaces it with one set up from the profile.
+_cache = ContentCache()
+
+def get_cache():
+    return _cache
+
+
+def set_cache(cache):
+    global _cache
+    _cache = cache
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
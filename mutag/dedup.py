@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Duplicate detection for the files in a maildir folder.
+#
+# Files are first bucketed by Message-ID and size (not counting the tags
+# header), which only needs the headers. Only files sharing a bucket get their
+# content hashed, again leaving the tags header out, so two copies of a
+# message that only differ in their tags are still duplicates.
+
+import os
+import re
+import mmap
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+# how much of the file we look at to find the end of the headers
+_head_size = 64*1024
+
+
+def _header_re(name):
+    return re.compile(b'^' + re.escape(name.encode('ascii')) + b':[^\n]*\n(?:[ \t][^\n]*\n)*',
+                      flags=re.MULTILINE | re.IGNORECASE)
+
+_msgid_re = _header_re('Message-ID')
+
+
+def _header_end(mm):
+    end = mm.find(b'\n\n', 0, _head_size)
+    if end == -1: return min(len(mm), _head_size)
+    else:         return end + 1
+
+
+class FileInfo(object):
+    """What we know about a candidate file"""
+    __slots__ = ['path', 'size', 'nlink', 'key', 'tags', 'tagsraw', 'digest']
+
+    def __init__(self, path, st):
+        self.path = path
+        self.size = st.st_size
+        self.nlink = st.st_nlink
+        self.key = None        # (message-id, size without the tags header)
+        self.tags = None       # span of the tags header
+        self.tagsraw = None    # the tags header itself
+        self.digest = None     # hash of the content without the tags header
+
+
+def _open_map(path):
+    with open(path, 'rb') as fd:
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def scan_headers(info, tags_re):
+    """Fills in info.key and info.tags from the file headers"""
+    mm = _open_map(info.path)
+    try:
+        head = mm[0:_header_end(mm)]
+    finally:
+        mm.close()
+
+    m = _msgid_re.search(head)
+    if m: msgid = m.group(0).split(b':', 1)[1].strip()
+    else: msgid = None
+
+    m = tags_re.search(head)
+    if m:
+        info.tags = (m.start(), m.end())
+        info.tagsraw = m.group(0)
+        size = info.size - (m.end() - m.start())
+    else:
+        info.tags = None
+        info.tagsraw = None
+        size = info.size
+
+    info.key = (msgid, size)
+
+
+def compute_digest(info):
+    """Hashes the file content, skipping the tags header"""
+    h = hashlib.blake2b(digest_size=20)
+    try:
+        mm = _open_map(info.path)
+    except (OSError, ValueError):
+        return info
+
+    try:
+        # hash straight from the mapping, without copying the content
+        with memoryview(mm) as mv:
+            if info.tags:
+                h.update(mv[0:info.tags[0]])
+                h.update(mv[info.tags[1]:])
+            else:
+                h.update(mv)
+    finally:
+        mm.close()
+    info.digest = h.digest()
+    return info
+
+
+def find_duplicates(paths, tagsheader='X-Keywords', workers=4):
+    """Returns a list of groups of duplicate files among paths. Each group is a
+    list of FileInfo, sorted by path."""
+    tags_re = _header_re(tagsheader)
+
+    # copies may differ in their tags header, so raw sizes are not comparable
+    # and the first pass looks at the headers of every file. Both passes read
+    # the files from a pool of threads. Empty files are never duplicates.
+    infos = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+        except OSError:
+            continue
+        if st.st_size > 0: infos.append(FileInfo(p, st))
+
+    def scan(info):
+        try:
+            scan_headers(info, tags_re)
+        except (OSError, ValueError):
+            return None
+        return info
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        buckets = {}
+        for info in pool.map(scan, infos):
+            if info != None: buckets.setdefault(info.key, []).append(info)
+
+        candidates = [info for b in buckets.values() if len(b) > 1 for info in b]
+        if len(candidates) == 0: return []
+
+        hashed = list(pool.map(compute_digest, candidates))
+
+    groups = {}
+    for info in hashed:
+        if info.digest == None: continue
+        groups.setdefault((info.key, info.digest), []).append(info)
+
+    return [sorted(g, key=lambda i: i.path) for g in groups.values() if len(g) > 1]
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
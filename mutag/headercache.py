@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A persistent cache of the fields mutag derives from message headers.
+#
+# Entries are keyed by path, and only valid while the inode, mtime and size of
+# the file are the same as when it was parsed. The whole cache is read and
+# written in one go, and the least recently used entries are dropped once it
+# grows over its maximum size.
+
+import os
+import pickle
+
+from collections import OrderedDict
+
+
+class HeaderCache(object):
+    def __init__(self, path, maxsize=100000):
+        self.path = path
+        self.maxsize = maxsize
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+
+
+    def _load(self):
+        if self._entries != None: return
+        try:
+            with open(self.path, 'rb') as fd:
+                self._entries = pickle.load(fd)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            self._entries = OrderedDict()
+
+        if not isinstance(self._entries, OrderedDict):
+            self._entries = OrderedDict()
+
+
+    def _stamp(self, st):
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+    def get(self, path, st):
+        """Returns the cached fields for path, or None if there are none or the
+        file changed. st is the os.stat of path."""
+        self._load()
+        ent = self._entries.get(path, None)
+        if ent != None and ent[0] == self._stamp(st):
+            self._entries.move_to_end(path)
+            self.hits = self.hits + 1
+            return ent[1]
+
+        self.misses = self.misses + 1
+        return None
+
+
+    def put(self, path, st, fields):
+        self._load()
+        self._entries[path] = (self._stamp(st), fields)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        self.dirty = True
+
+
+    def discard(self, path):
+        self._load()
+        if self._entries.pop(path, None) != None:
+            self.dirty = True
+
+
+    def __contains__(self, path):
+        self._load()
+        return path in self._entries
+
+
+    def save(self):
+        if not self.dirty: return
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'wb') as fd:
+            pickle.dump(self._entries, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmppath, self.path)
+        self.dirty = False
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Callbacks around mutag's hot paths.
+#
+# A callback registered for an event is called as callback(event, info), where
+# info is a dict. The events are
+#
+#   before-query, after-query   query; after adds count and elapsed
+#   before-parse, after-parse   path, None before parsing a mu record; after
+#                               adds msg, size and elapsed
+#   before-rules, after-rules   msg, rule ('get_tags' or 'expire'); after
+#                               adds result and elapsed
+#   before-write, after-write   path, kind ('tags', 'flags', 'link', 'delete'
+#                               or 'plan'); after adds size and elapsed
+#
+# elapsed is wall time in seconds, and size is in bytes. Callers check enabled
+# before building the info dict, so with nothing registered a hook site costs
+# an attribute lookup.
+#
+# Besides Mutag.hooks.register, a tagrules module can define
+#
+#   def register_hooks(register):
+#       register('after-write', callback)
+#
+# which is called each time the rules are loaded.
+
+EVENTS = ['before-query', 'after-query',
+          'before-parse', 'after-parse',
+          'before-rules', 'after-rules',
+          'before-write', 'after-write']
+
+
+class HookError(Exception):
+    def __init__(self, msg=None):
+        super().__init__(msg)
+
+
+class Hooks(object):
+    def __init__(self):
+        self._callbacks = {}    # event -> list of (callback, tag)
+        self.enabled = False
+
+
+    def register(self, event, callback, tag=None):
+        """Calls callback on event. tag names the registration, so it can be
+        removed later with remove(tag)."""
+        if not event in EVENTS:
+            raise HookError("unknown hook event '%s'" % event)
+        self._callbacks.setdefault(event, []).append((callback, tag))
+        self.enabled = True
+
+
+    def unregister(self, event, callback):
+        L = self._callbacks.get(event, [])
+        self._callbacks[event] = [(cb, tag) for cb, tag in L if cb != callback]
+        self._update()
+
+
+    def remove(self, tag):
+        """Unregisters every callback registered with tag"""
+        for event in self._callbacks:
+            self._callbacks[event] = [(cb, t) for cb, t in self._callbacks[event] if t != tag]
+        self._update()
+
+
+    def _update(self):
+        self._callbacks = {e: L for e, L in self._callbacks.items() if len(L) > 0}
+        self.enabled = len(self._callbacks) > 0
+
+
+    def fire(self, event, **info):
+        for cb, tag in self._callbacks.get(event, ()):
+            cb(event, info)
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
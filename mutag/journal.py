@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# An append-only journal of intended tags and flags, one json object per line:
+#
+#   {"path": "...", "time": ..., "tags": [...]}
+#   {"path": "...", "time": ..., "flags": [...]}
+#   {"path": "...", "time": ..., "forget": true}
+#
+# Later lines for a path override earlier ones, forget drops what was recorded
+# for it, so the journal can be replayed
+# into the final state of each file and written to the maildir in one pass.
+
+import os
+import json
+import time
+
+
+class TagJournal(object):
+    def __init__(self, path):
+        self.path = path
+        self._state = None
+        self._stamp = None
+        self._started = None
+
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_size, st.st_mtime)
+        except OSError:
+            return None
+
+
+    def append(self, path, tags=None, flags=None, forget=False):
+        entry = {'path': path, 'time': time.time()}
+        if tags != None:  entry['tags'] = sorted(tags)
+        if flags != None: entry['flags'] = sorted(flags)
+        if forget:        entry['forget'] = True
+
+        with open(self.path, 'a') as fd:
+            fd.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+        if self._state != None:
+            self._merge(self._state, entry)
+            self._stamp = self._file_stamp()
+            if self._started == None: self._started = entry['time']
+
+
+    def forget(self, path):
+        """Drops the recorded state of path"""
+        self.append(path, forget=True)
+
+
+    def _merge(self, state, entry):
+        if entry.get('forget', False):
+            state.pop(entry['path'], None)
+            return
+        st = state.setdefault(entry['path'], {})
+        if 'tags' in entry:  st['tags'] = set(entry['tags'])
+        if 'flags' in entry: st['flags'] = set(entry['flags'])
+
+
+    def state(self):
+        """Returns a dict path -> {'tags': set, 'flags': set} with the last
+        recorded state of each path. Either key may be missing."""
+        stamp = self._file_stamp()
+        if self._state != None and stamp == self._stamp:
+            return self._state
+
+        state = {}
+        self._started = None
+        if stamp != None:
+            with open(self.path, 'r') as fd:
+                for line in fd:
+                    # a torn last line after a crash is just ignored
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._merge(state, entry)
+                    if self._started == None: self._started = entry.get('time', None)
+
+        self._state = state
+        self._stamp = stamp
+        return state
+
+
+    def age(self):
+        """Seconds since the oldest entry was recorded, or None if empty"""
+        self.state()
+        if self._started == None: return None
+        return time.time() - self._started
+
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._state = {}
+        self._stamp = None
+        self._started = None
+
+
+    def __len__(self):
+        return len(self.state())
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -20,28 +20,44 @@
 import os
 import re
 import sys
-import pprint
 import time
-import socket
+import json
+import mmap
 
-from hashlib import md5
 from threading import Lock
 
 from datetime import datetime
-from email.parser import BytesParser
-from email.generator import BytesGenerator
-from email.header import decode_header
-import email.utils
 
-from email import charset
-# Set the email charset to quoted printable for headers and content.
-charset.add_charset('utf-8', charset.QP, charset.QP)
+# The email package is only needed when we read message files ourselves, not
+# for messages coming from mu. It is imported on first use by _email().
+_email_ready = False
+
+def _email():
+    global _email_ready
+    if not _email_ready:
+        from email import charset
+        # Set the email charset to quoted printable for headers and content.
+        charset.add_charset('utf-8', charset.QP, charset.QP)
+        _email_ready = True
+
+    import email.parser, email.header, email.utils
+    return email
 
 class MessageError(Exception):
     def __init__(self, msg=None):
         super().__init__(msg)
 
 
+def compile_literals(literals, ignorecase=False):
+    """Returns a bytes regex matching any of literals, which may be str or
+    bytes, for use with Message.search. Longer literals win over their
+    prefixes."""
+    L = [l.encode('utf-8') if isinstance(l, str) else l for l in literals]
+    L = sorted(set(L), key=len, reverse=True)
+    flags = re.IGNORECASE if ignorecase else 0
+    return re.compile(b'|'.join([re.escape(l) for l in L]), flags=flags)
+
+
 # This serves to produce unique filenames based on a sequential time.
 # Borrowed from offlineimap
 timeseq = 0
@@ -71,6 +87,14 @@ class Message(dict):
                 'Keywords'  : ' '}
 
 
+    _flag_names = {'D': 'draft',
+                   'F': 'flagged',
+                   'S': 'seen',
+                   'P': 'passed',
+                   'R': 'replied',
+                   'T': 'trashed'}
+
+
     def __init__(self):
         super().__init__()
         self.msg = None
@@ -102,14 +126,109 @@ class Message(dict):
             return '#M{0} #C{1} #G{2} #W[{3}#W]'.format(datestr, author, str(self['subject']), tagstr)
 
         elif fmt == 'raw':
+            import pprint
             return pprint.pformat(self, indent=2) + '\n\n'
 
+        elif fmt == 'jsonl':
+            return json.dumps(self.todict(), ensure_ascii=False, separators=(',', ':'))
+
+
+    _json_fields = ['docid', 'path', 'maildir', 'message-id', 'subject', 'priority', 'size']
+
+    def todict(self):
+        """Returns a dict with the message fields, ready to be json serialized"""
+        d = {}
+        for k in self._json_fields:
+            d[k] = self.get(k, None)
+
+        for k in ['from', 'to', 'cc']:
+            d[k] = self.get(k, [])
+
+        for k in ['flags', 'tags']:
+            d[k] = sorted(self.get(k, []))
+
+        if self.get('date', None): d['date'] = self['date'].isoformat()
+        else:                      d['date'] = None
+
+        # the same whether the message came from mu or from its file. mu gives
+        # docids as strings and message-ids without the angle brackets.
+        if d['docid'] != None:
+            try:
+                d['docid'] = int(d['docid'])
+            except ValueError:
+                d['docid'] = None
+        if d['message-id']:
+            d['message-id'] = d['message-id'].strip()
+            if d['message-id'].startswith('<') and d['message-id'].endswith('>'):
+                d['message-id'] = d['message-id'][1:-1]
+
+        return d
+
 
     def raw(self):
         with open(self['path'], 'r', errors='ignore') as fd:
             return fd.read()
 
 
+    def _copy_file(self, fd, out, size):
+        """Copies size bytes from fd to out. If out has a file descriptor, lets
+        the kernel do the copy with sendfile."""
+        try:
+            outfd = out.fileno()
+        except (AttributeError, OSError, ValueError):
+            outfd = None
+
+        offset = 0
+        if outfd != None and hasattr(os, 'sendfile'):
+            out.flush()
+            try:
+                while offset < size:
+                    n = os.sendfile(outfd, fd.fileno(), offset, size - offset)
+                    if n == 0: break
+                    offset = offset + n
+                return
+            except OSError:
+                # sendfile does not support this kind of output
+                if offset > 0: raise
+
+        fd.seek(offset)
+        while True:
+            chunk = fd.read(1 << 20)
+            if not chunk: break
+            out.write(chunk)
+
+
+    def write_raw(self, out):
+        """Writes the message file to the binary file object out, byte exact."""
+        with open(self['path'], 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            self._copy_file(fd, out, size)
+
+
+    _mbox_from_re = re.compile(b'^(>*From )', flags=re.MULTILINE)
+
+    def write_mbox(self, out):
+        """Writes the message to the binary file object out as an mboxrd entry.
+        Unless some body line needs quoting, the file is copied as is."""
+        if self.get('date', None): date = self['date'].timetuple()
+        else:                      date = time.gmtime(0)
+        out.write(('From MAILER-DAEMON %s\n' % time.asctime(date)).encode('ascii'))
+
+        with open(self['path'], 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            last = b'\n'
+            if size > 0:
+                with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    last = mm[size-1:size]
+                    if self._mbox_from_re.search(mm):
+                        out.write(self._mbox_from_re.sub(b'>\\1', mm[:]))
+                    else:
+                        self._copy_file(fd, out, size)
+
+        if last != b'\n': out.write(b'\n')
+        out.write(b'\n')
+
+
     def _fill_derived_fields(self):
         msg = self
         for k in ['from', 'to', 'cc']:
@@ -125,11 +244,14 @@ class Message(dict):
 
 
     def get_header(self, header):
+        if self.headers == None:
+            self.load_headers()
+
         if header in self.headers:
             # TODO: may want to use self.headers.get_all(), which returns a list and catches all of the headers
             raw = self.headers.get(header, "")
             ret = ""
-            for txt, enc in decode_header(raw):
+            for txt, enc in _email().header.decode_header(raw):
                 if enc == 'unknown':
                     ret = ret + str(txt, 'ascii', errors='ignore')
                 elif enc == 'unknown-8bit':
@@ -176,25 +298,41 @@ class Message(dict):
         self._fill_derived_fields()
 
 
+    def from_fields(self, d):
+        """Fills in just the given fields. Used for projected queries, where we
+        did not ask mu for the whole record."""
+        for k in d:
+            self[k] = d[k]
+
+
     def from_file(self, path, maildir):
         msg = self
         msg['path'] = path
         self.load_headers()
-        # TODO: priority, flags, size
+        # TODO: priority, size
 
-        # Parse filename
-        m = re.search('^(/[^/]*)/(cur|new|tmp)/(.*)$', path.replace(maildir, ''))
+        # Parse filename. The maildir is the folder below the root, nested or
+        # not, as mu has it: '/INBOX', '/[Gmail]/All Mail', or '/' for the root.
+        rel = '/' + os.path.relpath(path, maildir)
+        m = re.search('^(.*)/(cur|new|tmp)/([^/]*)$', rel)
         if m:
-            msg['maildir'] = m.group(1)
+            msg['maildir'] = m.group(1) or '/'
             fname = m.group(3)
             m = re.search('U=([0-9]*)', fname)
             if m:
                 msg['docid'] = int(m.group(1))
 
+        m = re.search(':2,([A-Za-z]*)$', path)
+        if m:
+            msg['flags'] = set([self._flag_names[c] for c in m.group(1) if c in self._flag_names])
+        else:
+            msg['flags'] = set()
+
         # TODO: should I remove < > from message-id ?
         msg['message-id'] = self.get_header('message-id')
         msg['subject'] = self.get_header('subject')
 
+        email = _email()
         datetup = email.utils.parsedate_tz(self.get_header('date'))
         if datetup:
             # TODO: implement proper handling of timezones!
@@ -220,17 +358,45 @@ class Message(dict):
         self._fill_derived_fields()
 
 
+    _cache_fields = ['path', 'maildir', 'docid', 'message-id', 'subject',
+                     'to', 'from', 'cc', 'tags', 'flags']
+
+    def to_cache(self):
+        """Returns the fields parsed by from_file as plain python data"""
+        d = {k: self[k] for k in self._cache_fields if k in self}
+        for k in ['tags', 'flags']:
+            if k in d: d[k] = sorted(d[k])
+        if self.get('date', None): d['date'] = self['date'].timestamp()
+        else:                      d['date'] = None
+        return d
+
+
+    def from_cache(self, d):
+        """Inverse of to_cache. The headers are loaded from the file only if
+        somebody asks for them."""
+        msg = self
+        for k in d:
+            msg[k] = d[k]
+        for k in ['tags', 'flags']:
+            msg[k] = set(d.get(k, []))
+        if d.get('date', None) != None: msg['date'] = datetime.fromtimestamp(d['date'])
+        else:                           msg['date'] = None
+        self._fill_derived_fields()
+
+
     def load_message(self):
         with open(self['path'], 'rb') as fd:
-            self.msg = BytesParser().parse(fd)
+            self.msg = _email().parser.BytesParser().parse(fd)
 
 
     def load_headers(self):
         with open(self['path'], 'rb') as fd:
-            self.headers = BytesParser().parse(fd, headersonly=True)
+            self.headers = _email().parser.BytesParser().parse(fd, headersonly=True)
 
 
     def get_content(self):
+        """Returns all the text parts of the message, parsing the whole file.
+        get_text is much cheaper for rules that look at the body."""
         if not self.msg:
             self.load_message()
 
@@ -241,6 +407,49 @@ class Message(dict):
         return '\n'.join(payload)
 
 
+    def get_text(self, limit=None):
+        """Returns the text of the message body, from at most limit bytes of the
+        file. Results are cached, see mutag.content."""
+        from mutag.content import get_cache
+        return get_cache().get(self['path'], limit)
+
+
+    def _scan(self, pattern, scope):
+        """Yields the matches of pattern in the message file, as bytes. scope is
+        'all', 'headers' or 'body'. The file is mmapped, so nothing is read
+        or copied other than the matches."""
+        if isinstance(pattern, bytes): pattern = re.compile(pattern)
+        if not scope in ('all', 'headers', 'body'):
+            raise MessageError("unknown search scope '%s'" % scope)
+
+        with open(self['path'], 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            if size == 0: return
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start, end = 0, size
+                if scope != 'all':
+                    hend = min([i for i in (mm.find(b'\n\n'), mm.find(b'\r\n\r\n')) if i >= 0] or [size])
+                    if scope == 'headers': end = hend
+                    else:                  start = hend
+                for m in pattern.finditer(mm, start, end):
+                    yield m.group(0)
+
+
+    def search(self, pattern, scope='all'):
+        """Returns the first match of pattern in the raw message, as bytes, or
+        None. pattern is a bytes regex, compiled or not, or the result of
+        compile_literals. Much cheaper than get_content for marker rules."""
+        for match in self._scan(pattern, scope):
+            return match
+        return None
+
+
+    def findall(self, pattern, scope='all'):
+        """Returns the set of distinct matches of pattern in the raw message.
+        With compile_literals, the literals present."""
+        return set(self._scan(pattern, scope))
+
+
     def message_addheader(self, content, headername, headervalue):
         """Changes the value of headername to headervalue if the header exists,
         or adds it if it does not exist"""
@@ -318,6 +527,8 @@ class Message(dict):
         :param uid: The UID`None`, or a set of maildir flags
         :param flags: A set of maildir flags
         :returns: String containing unique message filename"""
+        import socket
+        from hashlib import md5
         timeval, timeseq = gettimeseq()
         return '%d_%d.%d.%s,U=%d,FMD5=%s%s2,%s' % \
             (timeval, timeseq, os.getpid(), socket.gethostname(),
@@ -325,7 +536,7 @@ class Message(dict):
 
 
     def set_tags(self, tags):
-        """Sets tags of message"""
+        """Sets tags of message. Returns the number of bytes written."""
         with open(self['path'], 'rb') as fd:
             content = fd.read()
 
@@ -336,7 +547,8 @@ class Message(dict):
 
         # save changed file into temp path
         parent = os.path.dirname(os.path.dirname(self['path']))
-        messagename = self.new_message_filename(int(self['docid']), self['maildir'], set())
+        messagename = self.new_message_filename(int(self.get('docid', None) or 0),
+                                                self.get('maildir', None) or '', set())
         tmpname = self.save_tmp_file(messagename, content)
 
         # move back to initial position
@@ -344,6 +556,7 @@ class Message(dict):
 
         # update tags
         self['tags'] = set(tags)
+        return len(content)
 
 
     def get_mtime(self):
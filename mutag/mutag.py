@@ -22,16 +22,19 @@ import os
 import re
 import sys
 import glob
+import time
 import shlex
 import shutil
 import subprocess
 import datetime
 
-import inspect
 import importlib.machinery
 
 import mutag.plistseq as plistseq
 from mutag.message import Message
+from mutag.journal import TagJournal
+from mutag.stats import Stats
+from mutag.hooks import Hooks
 import mutag.archui as ui
 
 class MutagError(Exception):
@@ -63,6 +66,80 @@ class Mutag(object):
         self.lastmtime_path = prof['lastmtime']
         self.mtimelist_path = prof['mtimelist']
 
+        self.link_copies = prof.get('linkcopies', False)
+
+        # write-behind mode. Tag and flag changes go to the journal, and hit
+        # the maildir on flush_journal. The journal is always looked at, so
+        # changes deferred by an earlier run are seen and flushed.
+        self.write_behind = prof.get('writebehind', False)
+        self.journal_flush = prof.get('journalflush', 0)
+        jpath = prof.get('journal', None)
+        if not jpath and self.muhome: jpath = os.path.join(self.muhome, 'mutag.journal')
+        if jpath: self.journal = TagJournal(jpath)
+        else:     self.journal = None
+        self._flushing = False
+
+        # run mu queries in pages of this many messages, 0 to disable
+        self.page_size = prof.get('pagesize', 0)
+        self.page_prefetch = prof.get('prefetch', False)
+
+        # progress checkpoints for autotag and expire. Each command keeps its
+        # own file, named after this one, see _start_checkpoint.
+        self.checkpoint_path = prof.get('checkpoint', None)
+        if not self.checkpoint_path and self.muhome:
+            self.checkpoint_path = os.path.join(self.muhome, 'mutag.checkpoint')
+        self.checkpoint_interval = prof.get('checkpointinterval', 30)
+
+        # cache of the fields parsed from message headers
+        self.headercache = None
+        if prof.get('headercache', None):
+            from mutag.headercache import HeaderCache
+            self.headercache = HeaderCache(prof['headercache'], prof.get('headercachesize', 100000))
+
+        # text of message bodies for Message.get_text
+        from mutag.content import ContentCache, set_cache
+        self.contentcache = ContentCache(limit=prof.get('contentlimit', 64*1024),
+                                         maxsize=prof.get('contentcachesize', 1000),
+                                         path=prof.get('contentcache', None))
+        set_cache(self.contentcache)
+
+        # sqlite index of tags and flags, opened on first use
+        self.tagindex_path = prof.get('tagindex', None)
+        self._tagindex = None
+
+        self.git_untracked_cache = prof.get('gituntrackedcache', False)
+        self.git_fsmonitor = prof.get('gitfsmonitor', None)
+
+        # paths written, moved or removed during this run. Used to scope the
+        # git commit to just the files we touched.
+        self.changed_paths = set()
+
+        self._tagrules = None
+
+        # time spent per phase, reset by the caller between commands
+        self.stats = Stats()
+
+        # callbacks around queries, parsing, rules and writes
+        self.hooks = Hooks()
+
+        # when set, tag and flag changes are recorded here instead of written
+        self.plan = None
+        self.plan_workers = prof.get('planworkers', 4)
+
+        # background mode paces writes and backs off under load
+        self.throttle = None
+        if prof.get('background', False):
+            from mutag.throttle import Throttle
+            self.throttle = Throttle(files_per_sec=prof.get('backgroundwrites', 0),
+                                     bytes_per_sec=prof.get('backgroundbytes', 0),
+                                     max_load=prof.get('backgroundload', 0),
+                                     stats=self.stats)
+            self.throttle.install(self.hooks)
+
+        # mu queries are killed after this many seconds, 0 for no limit
+        self.mu_timeout = prof.get('mutimeout', 0)
+        self._running = set()
+
 
 
     # Auxiliar functions
@@ -76,21 +153,53 @@ class Mutag(object):
 
             cmd_args = [mu_cmd, cmd, '--muhome', self.muhome] + args
 
-            if catchout:
-                ret = subprocess.check_output(cmd_args, stderr=subprocess.STDOUT)
-                return ret.decode('utf-8')
-            else:
-                subprocess.check_call(cmd_args, stdout=out, stderr=out)
+            t = time.perf_counter()
+            try:
+                if catchout:
+                    ret = subprocess.check_output(cmd_args, stderr=subprocess.STDOUT)
+                    return ret.decode('utf-8')
+                else:
+                    subprocess.check_call(cmd_args, stdout=out, stderr=out)
+            finally:
+                self.stats.incr('mu_calls')
+                self.stats.incr('mu_seconds', time.perf_counter() - t)
 
 
 
-    def _mu_stream(self, cmd, args):
+    def _mu_stream(self, cmd, args, ok=(0,)):
+        """Yields the lines mu writes to stdout. Once they are all read, raises
+        MuError if mu timed out or exited with a status not in ok."""
+        from mutag.subproc import StreamProcess
         mu_cmd = 'mu'
         cmd_args = [mu_cmd, cmd, '--muhome', self.muhome] + args
 
-        proc = subprocess.Popen(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                universal_newlines=True)
-        return proc.stdout
+        t = self.stats.start()
+        proc = StreamProcess(cmd_args, timeout=self.mu_timeout)
+        self._running.add(proc)
+        try:
+            for line in proc.lines():
+                yield line
+        finally:
+            self._running.discard(proc)
+            self.stats.incr('mu_calls')
+            self.stats.incr('mu_seconds', time.perf_counter() - t[0])
+
+        if proc.timed_out:
+            raise MuError("mu %s timed out after %s seconds" % (cmd, self.mu_timeout))
+        if proc.cancelled:
+            raise MuError("mu %s was cancelled" % cmd)
+        if not proc.returncode in ok:
+            err = proc.stderr(lines=10).strip()[-4096:]
+            if err: raise MuError(err)
+            else:   raise MuError("mu %s exited with status %d" % (cmd, proc.returncode))
+
+
+
+    def cancel(self):
+        """Kills the mu queries in progress. They raise MuError in the thread
+        reading them. Safe to call from any thread."""
+        for proc in list(self._running):
+            proc.cancel()
 
 
 
@@ -126,9 +235,234 @@ class Mutag(object):
 
 
     def _load_tagrules(self):
+        # keep the rules around while the file is unchanged, so a long lived
+        # mutag process does not reload them on every command.
+        mtime = os.stat(self.tagrules_path).st_mtime
+        if self._tagrules and self._tagrules[0] == mtime:
+            return self._tagrules[1]
+
         loader = importlib.machinery.SourceFileLoader("tagrules", self.tagrules_path)
         module = loader.load_module("tagrules")
-        return module.TagRules(path=self.maildir)
+        tr = module.TagRules(path=self.maildir)
+
+        # the rules module may hook into mutag. Drop what an older version of
+        # it registered.
+        self.hooks.remove('tagrules')
+        if hasattr(module, 'register_hooks'):
+            module.register_hooks(lambda event, cb: self.hooks.register(event, cb, tag='tagrules'))
+        self._tagrules = (mtime, tr)
+        return tr
+
+
+    def _get_tagindex(self):
+        if self.tagindex_path and self._tagindex == None:
+            from mutag.tagindex import TagIndex
+            self._tagindex = TagIndex(self.tagindex_path)
+        return self._tagindex
+
+
+    def _index_update(self, msg, oldpath=None):
+        if self.tagindex_path:
+            self._get_tagindex().update(msg, oldpath=oldpath)
+
+
+    def _index_remove(self, path):
+        if self.tagindex_path:
+            self._get_tagindex().remove(path)
+
+
+    def _parse_file(self, path):
+        """Builds a Message from the file at path, using the header cache when
+        the file did not change since it was cached"""
+        if self.hooks.enabled: self.hooks.fire('before-parse', path=path)
+        t = self.stats.start()
+        msg = Message()
+        if self.headercache == None:
+            msg.from_file(path, maildir=self.maildir)
+        else:
+            st = os.stat(path)
+            fields = self.headercache.get(path, st)
+            if fields != None:
+                msg.from_cache(fields)
+            else:
+                msg.from_file(path, maildir=self.maildir)
+                self.headercache.put(path, st, msg.to_cache())
+        elapsed = self.stats.stop('parse', t)
+
+        if self.hooks.enabled:
+            self.hooks.fire('after-parse', path=path, msg=msg, size=os.path.getsize(path), elapsed=elapsed)
+        return msg
+
+
+    def _cache_update(self, msg, oldpath=None):
+        # keep cached entries of files we rewrite valid
+        if self.headercache == None: return
+        if oldpath and oldpath != msg['path']:
+            self.headercache.discard(oldpath)
+        elif msg['path'] in self.headercache:
+            self.headercache.put(msg['path'], os.stat(msg['path']), msg.to_cache())
+
+
+    def _record_change(self, *paths):
+        for p in paths:
+            if p: self.changed_paths.add(os.path.abspath(p))
+
+
+    def _journal_written(self, msg, oldpath, key):
+        """Called after a direct write of the key ('tags' or 'flags') of msg,
+        that was at oldpath. Keeps the journal from later putting back the
+        value it had recorded. What is still pending moves to the new path."""
+        if self.journal == None or self._flushing: return
+        pending = self.journal.state().get(oldpath, None)
+        if pending == None: return
+
+        # msg may show the journaled state through the overlay, so compare
+        # nothing with it
+        left = {k: v for k, v in pending.items() if k != key}
+        self.journal.forget(oldpath)
+        if len(left) > 0:
+            self.journal.append(msg['path'], tags=left.get('tags', None), flags=left.get('flags', None))
+
+
+    def _set_tags(self, msg, tags, defer=True):
+        if self.plan != None:
+            self.plan.add_tags(msg['path'], msg['tags'], tags)
+            msg['tags'] = set(tags)
+            return
+
+        if self.write_behind and self.journal != None and defer:
+            self.journal.append(msg['path'], tags=tags)
+            msg['tags'] = set(tags)
+            self._journal_check()
+            return
+
+        if self.hooks.enabled: self.hooks.fire('before-write', path=msg['path'], kind='tags')
+        t = self.stats.start()
+        nbytes = msg.set_tags(tags)
+        self.stats.incr('bytes_rewritten', nbytes)
+        self._record_change(msg['path'])
+        self._journal_written(msg, msg['path'], 'tags')
+        self._index_update(msg)
+        self._cache_update(msg)
+        elapsed = self.stats.stop('writes', t)
+
+        if self.hooks.enabled:
+            self.hooks.fire('after-write', path=msg['path'], kind='tags', size=nbytes, elapsed=elapsed)
+
+
+    def _link_copy(self, src, msg):
+        """Replaces the file of msg by a hardlink to the file of src"""
+        parent = os.path.dirname(os.path.dirname(msg['path']))
+        tmppath = os.path.join(parent, 'tmp', os.path.basename(msg['path']) + '.mutag')
+        if self.hooks.enabled: self.hooks.fire('before-write', path=msg['path'], kind='link')
+        t = self.stats.start()
+        os.link(src['path'], tmppath)
+        os.rename(tmppath, msg['path'])
+        # the flags are in the file name, which stays the same
+        msg['tags'] = set(src['tags'])
+        self._record_change(msg['path'])
+        self._index_update(msg)
+        self._cache_update(msg)
+        elapsed = self.stats.stop('writes', t)
+
+        if self.hooks.enabled:
+            self.hooks.fire('after-write', path=msg['path'], kind='link', size=0, elapsed=elapsed)
+
+
+    def _write_tags(self, changes):
+        """Writes a list of (msg, newtags) changes. If link_copies is set,
+        copies of a message in several folders with the same content (except for
+        the tags header) are rewritten once, and the rest become hardlinks to
+        the new file."""
+        if not self.link_copies or self.write_behind or self.plan != None:
+            for msg, tags in changes:
+                self._set_tags(msg, tags)
+            return
+
+        import mutag.dedup as dedup
+        tags_re = dedup._header_re(Message().tagsheader)
+
+        groups = {}
+        for msg, tags in changes:
+            if msg.get('message-id', None):
+                key = (msg['message-id'], frozenset(tags))
+                groups.setdefault(key, []).append(msg)
+            else:
+                self._set_tags(msg, tags)
+
+        for (msgid, tags), L in groups.items():
+            if len(L) == 1:
+                self._set_tags(L[0], tags)
+                continue
+
+            copies = {}
+            for msg in L:
+                info = dedup.FileInfo(msg['path'], os.stat(msg['path']))
+                dedup.scan_headers(info, tags_re)
+                dedup.compute_digest(info)
+                copies.setdefault((info.key, info.digest), []).append(msg)
+
+            for C in copies.values():
+                first = C[0]
+                self._set_tags(first, tags)
+                dev = os.stat(first['path']).st_dev
+                for msg in C[1:]:
+                    if os.stat(msg['path']).st_dev == dev:
+                        self._link_copy(first, msg)
+                    else:
+                        self._set_tags(msg, tags)
+
+
+    def _set_flags(self, msg, flags, defer=True):
+        if self.plan != None:
+            self.plan.add_flags(msg['path'], msg['flags'], flags)
+            msg['flags'] = set(flags)
+            return
+
+        if self.write_behind and self.journal != None and defer:
+            self.journal.append(msg['path'], flags=flags)
+            msg['flags'] = set(flags)
+            self._journal_check()
+            return
+
+        if self.hooks.enabled: self.hooks.fire('before-write', path=msg['path'], kind='flags')
+        t = self.stats.start()
+        oldpath = msg['path']
+        msg.set_flags(flags)
+        self._record_change(oldpath, msg['path'])
+        self._journal_written(msg, oldpath, 'flags')
+        self._index_update(msg, oldpath=oldpath)
+        self._cache_update(msg, oldpath=oldpath)
+        elapsed = self.stats.stop('writes', t)
+
+        # renames do not write any content
+        if self.hooks.enabled:
+            self.hooks.fire('after-write', path=msg['path'], kind='flags', size=0, elapsed=elapsed)
+
+
+    def _journal_check(self):
+        # flush if the oldest journaled change is older than journal_flush
+        if self.journal_flush > 0:
+            age = self.journal.age()
+            if age != None and age > self.journal_flush:
+                self.flush_journal()
+
+
+    def _journal_overlay(self, msglist):
+        """Applies the journaled tags and flags to the messages in msglist"""
+        if self.journal != None: state = self.journal.state()
+        else:                    state = {}
+
+        if len(state) == 0:
+            for msg in msglist: yield msg
+            return
+
+        for msg in msglist:
+            st = state.get(msg.get('path', None), None)
+            if st:
+                if 'tags' in st:  msg['tags'] = set(st['tags'])
+                if 'flags' in st: msg['flags'] = set(st['flags'])
+            yield msg
 
 
 
@@ -152,9 +486,24 @@ class Mutag(object):
     def get_maildir_files(self):
         files = []
         self._get_maildir_files_rec(files, self.maildir)
+        self.stats.incr('files_scanned', len(files))
         return files
 
 
+    def get_maildir_folders(self, path=None):
+        """Yields the maildir folders, the directories with a cur subdirectory"""
+        if path == None: path = self.maildir
+        if os.path.isdir(os.path.join(path, 'cur')):
+            yield path
+
+        for fd in sorted(os.listdir(path)):
+            newpath = os.path.join(path, fd)
+            if fd in ['cur', 'new', 'tmp'] or fd[0] == '.': continue
+            if os.path.isdir(newpath) and not self.should_ignore_path(newpath):
+                for it in self.get_maildir_folders(newpath):
+                    yield it
+
+
     def get_last_mtime(self):
         try:
             with open(self.lastmtime_path, 'r') as fd:
@@ -165,15 +514,18 @@ class Mutag(object):
 
 
 
-    def parsefiles(self, filelist):
+    def parsefiles(self, filelist, parse=True):
         for path in filelist:
             path = os.path.abspath(os.path.expanduser(path))
             if os.path.isfile(path):
                 rpath = os.path.realpath(path)
                 rmaildir = os.path.realpath(self.maildir)
                 if os.path.commonprefix([rpath, rmaildir]) == rmaildir:
-                    msg = Message()
-                    msg.from_file(path, maildir=self.maildir)
+                    if parse:
+                        msg = self._parse_file(path)
+                    else:
+                        msg = Message()
+                        msg.from_fields({'path': path})
                     yield msg
                 else:
                     ui.print_error("File does not belong to the configured maildir:\n%s" % path)
@@ -187,9 +539,7 @@ class Mutag(object):
         for mp in self.get_maildir_files():
             mt = float(os.stat(mp).st_mtime)
             if mt > mtime:
-                msg = Message()
-                msg.from_file(mp, maildir=self.maildir)
-                L.append(msg)
+                L.append(self._parse_file(mp))
         return L
 
 
@@ -203,6 +553,8 @@ class Mutag(object):
         if path and os.path.exists(path):
             shutil.move(path, newpath)
             msg['path'] = newpath
+            self._record_change(path, newpath)
+            self._index_update(msg, oldpath=path)
 
 
     def trash(self, msg):
@@ -213,50 +565,173 @@ class Mutag(object):
         """
         if os.path.exists(msg['path']):
             # tag as trashed
-            if self.trash_tag: msg.set_tags([self.trash_tag])
-            else:              msg.set_tags(['\\Trash'])
+            # the file is linked right away, so we can't defer writes
+            if self.trash_tag: self._set_tags(msg, [self.trash_tag], defer=False)
+            else:              self._set_tags(msg, ['\\Trash'], defer=False)
 
             # set maildir flags
-            msg.set_flags(['trashed', 'seen'])
+            self._set_flags(msg, ['trashed', 'seen'], defer=False)
 
             # make hard link in trash
-            os.link(msg['path'], os.path.join(self.trash_path, 'cur', os.path.basename(msg['path'])))
+            trashpath = os.path.join(self.trash_path, 'cur', os.path.basename(msg['path']))
+            os.link(msg['path'], trashpath)
+            self._record_change(trashpath)
 
             # remove from original folder only if it is not a gmail folder
             if not re.sub('^/', '', msg['maildir']) in self.gmail_folders:
                 os.unlink(msg['path'])
+                self._index_remove(msg['path'])
 
 
     # Mu database
     # ----------------------------------------------
 
-    def query_mu(self, query=None, mtime=None, related=False, thread=False):
-        args = ['--format=sexp']
+    def _mu_find_args(self, fmt, query=None, mtime=None, related=False, thread=False, extra=[]):
+        args = ['--format=%s' % fmt] + extra
         if thread:      args.append('--threads')
         if related:     args.append('--include-related')
         if mtime:       args.append('--after=%d' % int(mtime - 600))
         if query:       args.extend(shlex.split(query))
         else:           args.append("")
+        return args
 
-        cmd = 'find'
 
-        try:
-            stream = self._mu_stream(cmd, args)
 
-        except subprocess.CalledProcessError as err:
-            if err.returncode == 4:  return  # no results
-            elif err.output:         raise MuError(str(err.output.decode('utf-8')))
-            else:                    raise MuError(str(err))
+    def _query_mu_stream(self, args):
+        # mu find exits with status 4 when nothing matches
+        return self._mu_stream('find', args, ok=(0, 4))
+
+
+
+    def _query_mu_records(self, query=None, mtime=None, related=False, thread=False, extra=[]):
+        """Yields the raw sexp text of each record returned by mu find"""
+        args = self._mu_find_args('sexp', query, mtime, related=related, thread=thread, extra=extra)
 
         L = []
-        for line in stream:
+        for line in self._query_mu_stream(args):
             L.append(line)
             if line == ')\n':
-                sexp = plistseq.parse_plist('\n'.join(L))
+                yield '\n'.join(L)
                 L = []
+
+
+
+    # message fields that mu can output in plain format, and the --fields
+    # letter for each of them.
+    _plain_fields = {'path': 'l'}
+
+    def _query_mu_plain(self, field, query=None, mtime=None, related=False):
+        """Yields the value of a single field for each message, using mu plain
+        output. Much cheaper than sexp for mu and for us."""
+        args = self._mu_find_args('plain', query, mtime, related=related)
+        args.insert(1, '--fields=%s' % self._plain_fields[field])
+
+        for line in self._query_mu_stream(args):
+            line = line.rstrip('\n')
+            if len(line) > 0: yield line
+
+
+
+    def query_mu(self, query=None, mtime=None, related=False, thread=False, fields=None):
+        """Yields messages matching query. If fields is given, only those fields
+        are guaranteed to be filled in, and when possible a cheaper mu output
+        format is used."""
+        if fields and not thread and len(fields) == 1 and fields[0] in self._plain_fields:
+            for value in self.stats.iterate('query', self._query_mu_plain(fields[0], query, mtime, related=related)):
                 msg = Message()
-                msg.from_mudict(sexp)
+                msg.from_fields({fields[0]: value})
                 yield msg
+            return
+
+        for raw in self.stats.iterate('query', self._query_mu_records(query, mtime, related=related, thread=thread)):
+            yield self._parse_record(raw)
+
+
+
+    def _parse_record(self, raw):
+        """Builds a Message from a sexp record from mu"""
+        if self.hooks.enabled: self.hooks.fire('before-parse', path=None)
+        t = self.stats.start()
+        msg = Message()
+        msg.from_mudict(plistseq.parse_plist(raw))
+        elapsed = self.stats.stop('parse', t)
+
+        if self.hooks.enabled:
+            self.hooks.fire('after-parse', path=msg['path'], msg=msg, size=len(raw), elapsed=elapsed)
+        return msg
+
+
+
+    def _query_mu_page(self, query, mtime, related, since, size):
+        """Returns a list with the first size messages matching query, sorted by
+        date, and not older than since"""
+        if since:
+            window = 'date:%s..' % since.strftime('%Y%m%d%H%M%S')
+            if query: query = '(%s) AND %s' % (query, window)
+            else:     query = window
+
+        extra = ['--sortfield=date', '--maxnum=%d' % size]
+        L = []
+        for raw in self.stats.iterate('query', self._query_mu_records(query, mtime, related=related, extra=extra)):
+            L.append(self._parse_record(raw))
+        return L
+
+
+
+    def query_mu_paged(self, query=None, mtime=None, related=False, fields=None, pagesize=1000,
+                       prefetch=False):
+        """Like query_mu, but runs mu once per page of pagesize messages, so mu
+        is never left waiting on a full pipe while we process the results. Pages
+        are windows on the message date. If prefetch is set, the next page is
+        fetched in the background while the current one is processed. With
+        related set, messages outside a page's window may be yielded again.
+
+        When fields can be had from the plain output format, there is a single
+        plain query instead. Plain output carries no dates to move the window
+        with, and its lines are cheap enough that there is nothing to page."""
+        if fields and len(fields) == 1 and fields[0] in self._plain_fields:
+            for msg in self.query_mu(query, mtime, related=related, fields=fields):
+                yield msg
+            return
+
+        pool = None
+        if prefetch:
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(max_workers=1)
+
+        since = None    # date where the current page starts
+        skip = set()    # docids at since, already yielded by the previous page
+        size = pagesize
+        try:
+            page = self._query_mu_page(query, mtime, related, since, size)
+            while True:
+                full = len(page) >= size
+                last = page[-1]['date'] if len(page) > 0 else None
+
+                # the whole page has the same date, we can't move the window.
+                # Try again with a larger page.
+                if full and (last == None or page[0]['date'] == last):
+                    size = 2*size
+                    page = self._query_mu_page(query, mtime, related, since, size)
+                    continue
+
+                future = None
+                if full:
+                    nextskip = set([m['docid'] for m in page if m['date'] == last])
+                    if pool: future = pool.submit(self._query_mu_page, query, mtime, related, last, pagesize)
+
+                for msg in page:
+                    if not msg['docid'] in skip:
+                        yield msg
+
+                if not full: break
+
+                since, skip, size = last, nextskip, pagesize
+                if future: page = future.result()
+                else:      page = self._query_mu_page(query, mtime, related, since, size)
+
+        finally:
+            if pool: pool.shutdown(wait=False)
 
 
 
@@ -323,18 +798,84 @@ class Mutag(object):
     # Interface
     # ----------------------------------------------
 
-    def query(self, query=None, path=None, modified_only=False, related=False, thread=False):
+    def _index_terms(self, query, modified_only=False, related=False, thread=False):
+        """Returns the parsed query if it can be answered from the tag index,
+        or None"""
+        if not self.tagindex_path or modified_only or related or thread:
+            return None
+        # never populated, better ask mu
+        if self._get_tagindex().empty():
+            return None
+        from mutag.tagindex import parse_query
+        terms = parse_query(query)
+        if terms and any([f == 'maildir' for neg, f, v in terms]) and \
+           not self._get_tagindex().knows_maildirs():
+            return None
+        return terms
+
+
+
+    def query(self, query=None, path=None, modified_only=False, related=False, thread=False,
+              fields=None, use_index=False):
+        """Returns an iterator over the messages matching query, or the file at
+        path if given"""
+        it = self._query(query, path, modified_only, related, thread, fields, use_index)
+        if self.hooks.enabled:
+            it = self._hooked_query(it, query)
+        return it
+
+
+
+    def _hooked_query(self, it, query):
+        self.hooks.fire('before-query', query=query)
+        t = time.perf_counter()
+        count = 0
+        try:
+            for msg in it:
+                count = count + 1
+                yield msg
+        finally:
+            self.hooks.fire('after-query', query=query, count=count, elapsed=time.perf_counter() - t)
 
-        if path:
-            for it in self.parsefiles([path]):
-                yield it
+
+
+    def _query(self, query, path, modified_only, related, thread, fields, use_index):
+        terms = None
+        if use_index and not path:
+            terms = self._index_terms(query, modified_only, related, thread)
+
+        if terms != None:
+            paths = self.stats.iterate('query', self._get_tagindex().paths(terms))
+            if fields and set(fields) == set(['path']):
+                for it in self.parsefiles(paths, parse=False):
+                    yield it
+            else:
+                for it in self._journal_overlay(self.parsefiles(paths)):
+                    yield it
+
+        elif path:
+            if fields and set(fields) == set(['path']):
+                # no need to look into the file
+                for it in self.parsefiles([path], parse=False):
+                    yield it
+            else:
+                for it in self._journal_overlay(self.parsefiles([path])):
+                    yield it
 
         else:
             if modified_only: mtime = self.get_last_mtime()
             else:             mtime = None
 
-            qit = self.query_mu(query, mtime, related=related, thread=thread)
-            for it in qit:
+            # related messages fall outside the date window of a page, and
+            # would come back again with every later one. So autotag and
+            # expire, which need them, are never paged.
+            if self.page_size > 0 and not thread and not related:
+                qit = self.query_mu_paged(query, mtime, related=related, fields=fields,
+                                          pagesize=self.page_size, prefetch=self.page_prefetch)
+            else:
+                qit = self.query_mu(query, mtime, related=related, thread=thread, fields=fields)
+
+            for it in self._journal_overlay(qit):
                 yield it
 
 
@@ -346,126 +887,546 @@ class Mutag(object):
 
 
 
-    def count(self, query, modified_only=False):
+    def count(self, query, modified_only=False, use_index=False):
+        # journaled changes are only seen through the overlay, so count what a
+        # listing would show
+        if self.journal != None and len(self.journal) > 0:
+            L = self.query(query, modified_only=modified_only, related=False,
+                           fields=['path'], use_index=use_index)
+            try:
+                return sum(1 for msg in L)
+            except MuError:
+                return 0
+
+        if use_index:
+            terms = self._index_terms(query, modified_only)
+            if terms != None:
+                with self.stats.phase('query'):
+                    return self._get_tagindex().count(terms)
+
         if modified_only: mtime = self.get_last_mtime()
         else:             mtime = None
 
         try:
-            return len(list(self.query_mu(query, mtime, related=False)))
+            # ask mu for just the paths, no need for full records to count
+            return sum(1 for p in self.stats.iterate('query', self._query_mu_plain('path', query, mtime, related=False)))
 
         except MuError:
             return 0
 
 
 
-    def change_tags(self, msglist, tagactions, dryrun=False, silent=False):
-        addtags = set()
-        deltags = set()
-        for ta in tagactions:
-            mdel = re.search('^\s*-(.*)\s*$', ta)
-            madd = re.search('^\s*\+(.*)\s*$', ta)
+    def parse_actions(self, actions):
+        """Splits a list of '+tag', '-tag' or 'tag' actions into the sets of
+        things to add and to remove"""
+        add = set()
+        rem = set()
+        for a in actions:
+            mdel = re.search('^\s*-(.*)\s*$', a)
+            madd = re.search('^\s*\+(.*)\s*$', a)
+
+            if mdel:   rem.add(mdel.group(1))
+            elif madd: add.add(madd.group(1))
+            else:      add.add(a.strip())
+        return add, rem
+
+
 
-            if mdel:   deltags.add(mdel.group(1))
-            elif madd: addtags.add(madd.group(1))
-            else:      addtags.add(ta.strip())
+    def change_tags(self, msglist, tagactions, dryrun=False, silent=False):
+        addtags, deltags = self.parse_actions(tagactions)
 
+        changes = []
         for msg in msglist:
+            self.stats.incr('processed')
             tags = set(msg['tags'])
             newtags = tags.union(addtags).difference(deltags)
             if tags != newtags:
+                self.stats.incr('retagged')
                 if not silent: self._print_tagschange(msg, tags, newtags)
-                if not dryrun: msg.set_tags(newtags)
+                if dryrun:                 pass
+                elif self.link_copies:     changes.append((msg, newtags))
+                else:                      self._set_tags(msg, newtags)
 
+        self._write_tags(changes)
 
 
-    def change_flags(self, msglist, flagactions, dryrun=False, silent=False):
-        addflags = set()
-        delflags = set()
-        for fa in flagactions:
-            mdel = re.search('^\s*-(.*)\s*$', fa)
-            madd = re.search('^\s*\+(.*)\s*$', fa)
 
-            if mdel:   delflags.add(mdel.group(1))
-            elif madd: addflags.add(madd.group(1))
-            else:      addflags.add(fa.strip())
+    def change_flags(self, msglist, flagactions, dryrun=False, silent=False):
+        addflags, delflags = self.parse_actions(flagactions)
 
         for msg in msglist:
+            self.stats.incr('processed')
             flags = set(msg['flags'])
             newflags = flags.union(addflags).difference(delflags)
             if flags != newflags:
                 if not silent: self._print_tagschange(msg, flags, newflags)
-                if not dryrun: msg.set_flags(newflags)
+                if not dryrun: self._set_flags(msg, newflags)
+
+
+
+    def _stage(self, staged, msg):
+        path = msg['path']
+        if not path in staged:
+            staged[path] = {'msg': msg, 'tags': set(msg['tags']), 'flags': set(msg['flags'])}
+        return staged[path]
+
+
+
+    def stage_tags(self, msglist, tagactions, staged, silent=False):
+        """Like change_tags, but only records the new tags in the staged dict,
+        keyed by path. Several calls on the same file are merged, and
+        write_staged writes each file once. Returns the number of messages
+        whose tags changed."""
+        addtags, deltags = self.parse_actions(tagactions)
+        count = 0
+        for msg in msglist:
+            st = self._stage(staged, msg)
+            newtags = st['tags'].union(addtags).difference(deltags)
+            if st['tags'] != newtags:
+                count = count + 1
+                if not silent: self._print_tagschange(msg, st['tags'], newtags)
+                st['tags'] = newtags
+        return count
+
+
+
+    def stage_flags(self, msglist, flagactions, staged, silent=False):
+        """Flags counterpart of stage_tags"""
+        addflags, delflags = self.parse_actions(flagactions)
+        count = 0
+        for msg in msglist:
+            st = self._stage(staged, msg)
+            newflags = st['flags'].union(addflags).difference(delflags)
+            if st['flags'] != newflags:
+                count = count + 1
+                if not silent: self._print_tagschange(msg, st['flags'], newflags)
+                st['flags'] = newflags
+        return count
+
+
+
+    def write_staged(self, staged, dryrun=False, silent=False):
+        """Writes the changes recorded by stage_tags and stage_flags, at most
+        one rewrite and one rename per file. Returns the number of files
+        changed."""
+        count = 0
+        for path, st in staged.items():
+            msg = st['msg']
+            tagsch = st['tags'] != set(msg['tags'])
+            flagsch = st['flags'] != set(msg['flags'])
+            self.stats.incr('processed')
+            if tagsch: self.stats.incr('retagged')
+            if tagsch or flagsch:
+                count = count + 1
+                if dryrun: continue
+
+                # the tags are rewritten in place, so do them before the flags
+                # rename the file.
+                if tagsch:  self._set_tags(msg, st['tags'])
+                if flagsch: self._set_flags(msg, st['flags'])
+        return count
+
+
+
+    def _rules_fingerprint(self):
+        import hashlib
+        with open(self.tagrules_path, 'rb') as fd:
+            return hashlib.sha1(fd.read()).hexdigest()
+
+
+
+    def _start_checkpoint(self, run, resume=False, dryrun=False):
+        """Returns a started Checkpoint for the given run, or None if we do not
+        keep checkpoints"""
+        if dryrun or not self.checkpoint_path: return None
 
+        from mutag.checkpoint import Checkpoint
+        # mutag.checkpoint -> mutag.autotag.checkpoint, so an autotag run does
+        # not throw away the progress of an interrupted expire
+        root, ext = os.path.splitext(self.checkpoint_path)
+        path = '%s.%s%s' % (root, run['command'], ext)
 
+        run = dict(run, maildir=self.maildir, rules=self._rules_fingerprint())
+        cp = Checkpoint(path, run, interval=self.checkpoint_interval)
+        num = cp.start(resume=resume)
+        if resume and num > 0:
+            ui.print_color("  resuming, skipping #G%d#t messages already processed" % num)
+        return cp
 
-    def autotag(self, query, path=None, modified_only=True, related=True, dryrun=False, silent=False):
+
+
+    def autotag(self, query, path=None, modified_only=True, related=True, dryrun=False, silent=False,
+                resume=False):
         ui.print_color("Autotaging new messages under #B%s#t" % self.maildir)
+        tr = self._load_tagrules()
+
         ui.print_color("  retrieving messages")
         msglist = self.query(query, path=path, modified_only=modified_only, related=related, thread=True)
         L = list(msglist)
 
         ui.print_color("  collecting thread data")
-        self.collect_thread_data(L)
+        with self.stats.phase('thread data', count=len(L)):
+            self.collect_thread_data(L)
 
         ui.print_color("  retagging messages")
-        tr = self._load_tagrules()
-        tagged_count = 0
-        for msg in L:
-            if self.should_ignore_path(os.path.join(self.maildir, re.sub('^/', '', msg['maildir']))):
-                continue
-
-            tags = set(msg['tags'])
-
-            if self.trash_tag in tags or 'trashed' in msg['flags']  or 'deleted' in msg['flags']:
-                continue
-
-            newtags = tr.get_tags(msg)
-            ui.print_debug("%s -> %s" % (', '.join(tags), ', '.join(newtags)))
-            if tags != newtags:
-                tagged_count = tagged_count + 1
-                if not silent: self._print_tagschange(msg, tags, newtags)
-                if not dryrun: msg.set_tags(newtags)
+        run = {'command': 'autotag', 'query': query, 'path': path, 'modified': modified_only}
+        cp = self._start_checkpoint(run, resume=resume, dryrun=dryrun or self.plan != None)
 
+        tagged_count = 0
+        changes = []
+        processed = []
+        try:
+            for msg in L:
+                if cp and cp.done(msg['path']): continue
+                processed.append(msg['path'])
+
+                if self.should_ignore_path(os.path.join(self.maildir, re.sub('^/', '', msg['maildir']))):
+                    continue
+
+                tags = set(msg['tags'])
+
+                if self.trash_tag in tags or 'trashed' in msg['flags']  or 'deleted' in msg['flags']:
+                    continue
+
+                if self.hooks.enabled: self.hooks.fire('before-rules', msg=msg, rule='get_tags')
+                t = self.stats.start()
+                newtags = tr.get_tags(msg)
+                elapsed = self.stats.stop('rules', t)
+                if self.hooks.enabled:
+                    self.hooks.fire('after-rules', msg=msg, rule='get_tags', result=newtags, elapsed=elapsed)
+                ui.print_debug("%s -> %s" % (', '.join(tags), ', '.join(newtags)))
+                if tags != newtags:
+                    tagged_count = tagged_count + 1
+                    if not silent: self._print_tagschange(msg, tags, newtags)
+                    if not dryrun: changes.append((msg, newtags))
+
+                # write what we have, and only then record it as done
+                if cp and cp.due():
+                    self._write_tags(changes)
+                    cp.mark(processed)
+                    changes = []
+                    processed = []
+
+            self._write_tags(changes)
+
+        finally:
+            if cp: cp.close()
+
+        if cp: cp.remove()
+        self.stats.incr('processed', len(L))
+        self.stats.incr('retagged', tagged_count)
         ui.print_color("Processed #G%d#t files, and retagged #G%d#t." % (len(L), tagged_count))
 
 
 
-    def expire(self, dryrun=False, silent=False):
+    def expire(self, dryrun=False, silent=False, resume=False):
         """Marks all messages that need expiring as trashed"""
         ui.print_color("Expiring old messages under #B%s#t" % self.maildir)
         tr = self._load_tagrules()
         expire_date = datetime.datetime.today() - datetime.timedelta(days=self.expire_days)
 
+        # the query changes with the date, so it does not identify the run
+        run = {'command': 'expire', 'days': self.expire_days}
+        cp = self._start_checkpoint(run, resume=resume, dryrun=dryrun)
+
+        count = 0
         expired_count = 0
         msglist = self.query(query=tr.expire_query(expire_date), related=True)
-        for msg in msglist:
-            if self.should_ignore_path(os.path.join(self.maildir, re.sub('^/', '', msg['maildir']))):
+        try:
+            for msg in msglist:
+                count = count + 1
+                if cp and cp.done(msg['path']): continue
+                key = msg['path']
+
+                if self.should_ignore_path(os.path.join(self.maildir, re.sub('^/', '', msg['maildir']))):
+                    continue
+
+                if not self.trash_tag in msg['tags'] and msg['date'] and msg['date'] < expire_date:
+                    if self.hooks.enabled: self.hooks.fire('before-rules', msg=msg, rule='expire')
+                    t = self.stats.start()
+                    expired = tr.expire(msg)
+                    elapsed = self.stats.stop('rules', t)
+                    if self.hooks.enabled:
+                        self.hooks.fire('after-rules', msg=msg, rule='expire', result=expired, elapsed=elapsed)
+                    if expired:
+                        if not silent: self._print_expired(msg)
+                        expired_count = expired_count + 1
+                        if not dryrun: self.trash(msg)
+                    else:
+                        tags = msg['tags']
+                        if not dryrun: self._set_tags(msg, tags | set([tr.noexpire_tag]))
+
+                if cp: cp.mark([key])
+
+        finally:
+            if cp: cp.close()
+
+        if cp: cp.remove()
+        self.stats.incr('processed', count)
+        self.stats.incr('expired', expired_count)
+        ui.print_color("Processed #G%d#t files, and expired #G%d#t." % (count, expired_count))
+
+
+
+    def _dedup_merge(self, group):
+        """Gives the first file of a group of duplicates the union of the tags
+        and flags of all of them, so removing the rest loses nothing"""
+        L = [self._parse_file(info.path) for info in group]
+        keep = L[0]
+        tags = set().union(*[m['tags'] for m in L])
+        flags = set().union(*[m['flags'] for m in L])
+        if tags != keep['tags']:   self._set_tags(keep, tags, defer=False)
+        if flags != keep['flags']: self._set_flags(keep, flags, defer=False)
+        group[0].path = keep['path']
+
+
+
+    def dedup(self, dryrun=False, silent=False, hardlink=False, workers=4):
+        """Removes duplicate messages within each maildir folder. Messages are
+        duplicates if they have the same content except for the tags header.
+        The copy whose path sorts first is kept, and gets the tags and flags of
+        all the copies. If hardlink is set, the other copies become hardlinks
+        to it instead of being removed, as long as they have the same tags."""
+        import mutag.dedup as dedup
+
+        ui.print_color("Removing duplicates under #B%s#t" % self.maildir)
+        dup_count = 0
+        reclaimed = 0
+        for folder in self.get_maildir_folders():
+            # folders are processed one at a time, to bound memory usage
+            files = []
+            for sub in ['cur', 'new']:
+                subdir = os.path.join(folder, sub)
+                if not os.path.isdir(subdir): continue
+                files.extend([os.path.join(subdir, f) for f in os.listdir(subdir) if f[0] != '.'])
+            self.stats.incr('files_scanned', len(files))
+
+            groups = dedup.find_duplicates(files, tagsheader=Message().tagsheader, workers=workers)
+            for group in groups:
+                keep = group[0]
+                if not hardlink and not dryrun:
+                    self._dedup_merge(group)
+                for info in group[1:]:
+                    if hardlink:
+                        if keep.tagsraw != info.tagsraw: continue
+                        if os.path.samefile(keep.path, info.path): continue
+
+                    dup_count = dup_count + 1
+                    if info.nlink == 1: reclaimed = reclaimed + info.size
+                    if not silent:
+                        ui.print_color("duplicate: #W%s#t of #W%s#t" % (info.path, os.path.basename(keep.path)))
+                    if dryrun: continue
+
+                    kind = 'link' if hardlink else 'delete'
+                    if self.hooks.enabled: self.hooks.fire('before-write', path=info.path, kind=kind)
+                    t = self.stats.start()
+                    if hardlink:
+                        tmppath = info.path + '.mutag-link'
+                        os.link(keep.path, tmppath)
+                        os.rename(tmppath, info.path)
+                    else:
+                        os.unlink(info.path)
+                        self._index_remove(info.path)
+                    self._record_change(info.path)
+                    elapsed = self.stats.stop('writes', t)
+                    if self.hooks.enabled:
+                        self.hooks.fire('after-write', path=info.path, kind=kind, size=0, elapsed=elapsed)
+
+        ui.print_color("Found #G%d#t duplicates, reclaimed #G%.1f#t MB." % (dup_count, reclaimed / 1048576.0))
+        return dup_count, reclaimed
+
+
+
+    def update_tagindex(self, dryrun=False, silent=False):
+        """Brings the tag index up to date with the maildir. Only files whose
+        mtime or size changed since they were indexed are parsed."""
+        if not self.tagindex_path: return
+
+        ui.print_color("  updating tag index")
+        idx = self._get_tagindex()
+        known = idx.mtimes()
+        updated = 0
+        for mp in self.get_maildir_files():
+            st = os.stat(mp)
+            if known.pop(mp, None) != (st.st_mtime, st.st_size):
+                updated = updated + 1
+                if dryrun: continue
+                idx.update(self._parse_file(mp))
+
+        # whatever is left is gone from the maildir
+        if not dryrun:
+            for mp in known: idx.remove(mp)
+            idx.commit()
+
+        ui.print_debug("tag index: %d updated, %d removed" % (updated, len(known)))
+
+
+
+    def tag_histogram(self):
+        """Returns a list of (tag, count) from the tag index"""
+        if not self.tagindex_path:
+            raise MutagError("no tagindex configured for this profile")
+        return self._get_tagindex().histogram()
+
+
+
+    def finish(self):
+        """Called when a command is done, to persist any pending state"""
+        if self._tagindex != None: self._tagindex.commit()
+        if self.headercache != None:
+            self.headercache.save()
+            ui.print_debug("header cache: %d hits, %d misses" % (self.headercache.hits, self.headercache.misses))
+        self.contentcache.save()
+        if self.contentcache.hits + self.contentcache.misses > 0:
+            ui.print_debug("content cache: %d hits, %d misses" % (self.contentcache.hits, self.contentcache.misses))
+
+
+
+    def start_plan(self):
+        """From now on, tag and flag changes are recorded in a plan instead of
+        being written. Only meant for autotag, change_tags and change_flags."""
+        from mutag.plan import Plan
+        self.plan = Plan(self.maildir)
+
+
+
+    def save_plan(self, path):
+        """Writes the plan to path, and goes back to writing changes. Returns
+        the number of files in the plan."""
+        plan = self.plan
+        self.plan = None
+        try:
+            plan.save(path)
+        except OSError as err:
+            raise MutagError("could not write plan %s: %s" % (path, err.strerror or str(err)))
+        return len(plan)
+
+
+
+    def _apply_entry(self, ent):
+        """Applies a plan entry to its file. Runs in a worker thread, so it only
+        touches the file. Returns (status, msg, oldpath, nbytes, elapsed)."""
+        from mutag.plan import file_digest
+        path = os.path.join(self.maildir, ent['path'])
+        try:
+            if file_digest(path) != ent['digest']:
+                return ('changed', None, path, 0, 0)
+        except OSError:
+            return ('missing', None, path, 0, 0)
+
+        if self.hooks.enabled: self.hooks.fire('before-write', path=path, kind='plan')
+        t = time.perf_counter()
+        msg = Message()
+        msg.from_file(path, maildir=self.maildir)
+
+        nbytes = 0
+        # the tags are rewritten in place, so do them before the flags
+        # rename the file.
+        if 'tags' in ent and set(ent['tags']) != msg['tags']:
+            nbytes = msg.set_tags(ent['tags'])
+        if 'flags' in ent and set(ent['flags']) != msg['flags']:
+            msg.set_flags(ent['flags'])
+        return ('applied', msg, path, nbytes, time.perf_counter() - t)
+
+
+
+    def apply_plan(self, planpath, dryrun=False, silent=False):
+        """Applies the plan at planpath, with plan_workers files written at
+        once. Entries whose file changed since the plan was made are skipped.
+        Returns the number of files changed."""
+        from mutag.plan import load_plan, PlanError
+        from concurrent.futures import ThreadPoolExecutor
+
+        try:
+            header, entries = load_plan(planpath)
+        except (OSError, PlanError) as err:
+            raise MutagError(str(err))
+
+        ui.print_color("Applying plan #B%s#t with #G%d#t changes" % (planpath, len(entries)))
+        if dryrun: return 0
+
+        counts = {'applied': 0, 'changed': 0, 'missing': 0}
+        with ThreadPoolExecutor(max_workers=max(1, self.plan_workers)) as pool:
+            for status, msg, oldpath, nbytes, elapsed in pool.map(self._apply_entry, entries):
+                counts[status] = counts[status] + 1
+                if status != 'applied':
+                    if not silent: ui.print_color("#Rskipped#t (%s): %s" % (status, oldpath))
+                    continue
+
+                # bookkeeping stays in this thread
+                self.stats.incr('processed')
+                self.stats.incr('bytes_rewritten', nbytes)
+                # cpu time of the workers is not known, only wall time
+                self.stats.add('writes', elapsed, 0.0)
+                self._record_change(oldpath, msg['path'])
+                self._index_update(msg, oldpath=oldpath)
+                self._cache_update(msg, oldpath=oldpath)
+                if self.hooks.enabled:
+                    self.hooks.fire('after-write', path=msg['path'], kind='plan', size=nbytes, elapsed=elapsed)
+
+        ui.print_color("Applied #G%d#t changes, skipped #G%d#t changed and #G%d#t missing files." %
+                       (counts['applied'], counts['changed'], counts['missing']))
+        return counts['applied']
+
+
+
+    def flush_journal(self, dryrun=False, silent=False):
+        """Writes the final state of every journaled file to the maildir, once
+        per file, and empties the journal. Returns the number of files changed."""
+        if self.journal == None: return 0
+
+        state = self.journal.state()
+        if len(state) == 0: return 0
+
+        ui.print_color("  flushing %d journaled changes" % len(state))
+        count = 0
+        self._flushing = True
+        try:
+            count = self._flush_state(state, dryrun=dryrun)
+        finally:
+            self._flushing = False
+
+        if not dryrun: self.journal.clear()
+        return count
+
+
+
+    def _flush_state(self, state, dryrun=False):
+        count = 0
+        for path, st in state.items():
+            if not os.path.exists(path):
+                ui.print_warning("journaled file no longer exists:\n%s" % path)
                 continue
 
-            if not self.trash_tag in msg['tags'] and msg['date'] and msg['date'] < expire_date:
-                if tr.expire(msg):
-                    if not silent: self._print_expired(msg)
-                    expired_count = expired_count + 1
-                    if not dryrun: self.trash(msg)
-                else:
-                    tags = msg['tags']
-                    if not dryrun: msg.set_tags(tags | set([tr.noexpire_tag]))
+            msg = self._parse_file(path)
+            tagsch = 'tags' in st and st['tags'] != msg['tags']
+            flagsch = 'flags' in st and st['flags'] != msg['flags']
+            if not (tagsch or flagsch): continue
 
-        ui.print_color("Processed #G%d#t files, and expired #G%d#t." % (len(msglist), expired_count))
+            count = count + 1
+            if dryrun: continue
+
+            if tagsch:  self._set_tags(msg, st['tags'], defer=False)
+            if flagsch: self._set_flags(msg, st['flags'], defer=False)
+        return count
 
 
 
     def index(self, dryrun=False, silent=False):
+        self.flush_journal(dryrun=dryrun, silent=silent)
         args = ['--maildir', self.maildir, '--autoupgrade']
         if silent: args.append('--quiet')
         ui.print_color("  indexing new messages")
         try:
-            if not dryrun: self._mu('index', args, catchout=True)
+            with self.stats.phase('index'):
+                if not dryrun: self._mu('index', args, catchout=True)
 
         except subprocess.CalledProcessError as err:
             if err.output:  raise MuError(str(err.output.decode('utf-8')))
             else:           raise MuError(str(err))
 
+        self.update_tagindex(dryrun=dryrun, silent=silent)
+
 
 
     def rebuild(self, dryrun=False, silent=False):
@@ -473,7 +1434,8 @@ class Mutag(object):
         ui.print_color("  rebuilding index")
         if silent: args.append('--quiet')
         try:
-            if not dryrun: self._mu('index', args, catchout=False)
+            with self.stats.phase('index'):
+                if not dryrun: self._mu('index', args, catchout=False)
 
         except subprocess.CalledProcessError as err:
             if err.output:  raise MuError(str(err.output.decode('utf-8')))
@@ -485,42 +1447,136 @@ class Mutag(object):
         ui.print_color("Deleting messages in #B%s#t" % self.trash_path)
         for f in glob.glob(os.path.join(self.trash_path, '*', '*')):
             if not silent: ui.print_color("deleting: %s" % f)
-            if not dryrun: os.remove(f)
+            if not dryrun:
+                if self.hooks.enabled: self.hooks.fire('before-write', path=f, kind='delete')
+                t = self.stats.start()
+                os.remove(f)
+                self._record_change(f)
+                self._index_remove(f)
+                elapsed = self.stats.stop('writes', t)
+                if self.hooks.enabled:
+                    self.hooks.fire('after-write', path=f, kind='delete', size=0, elapsed=elapsed)
 
 
 
     def update_mtime(self, dryrun=False, silent=False):
         ui.print_color("  updating last mtime")
+        t = self.stats.start()
         L = self.get_maildir_files()
         if len(L) > 0:
             mtime = max([float(os.stat(mp).st_mtime) for mp in L])
             if not dryrun:
                 with open(self.lastmtime_path, 'w') as fd:
                     fd.write(str(mtime))
+        self.stats.stop('mtime update', t, len(L))
 
 
 
-    def commit(self, dryrun=False, silent=False):
+    def _git_setup_fastscan(self):
+        """Enables git features that speed up status scans on large maildirs"""
+        if self.git_untracked_cache:
+            self._git(['config', 'core.untrackedCache', 'true'], tgtdir=self.maildir,
+                      catchout=True, silent=True)
+
+        if self.git_fsmonitor:
+            self._git(['config', 'core.fsmonitor', self.git_fsmonitor], tgtdir=self.maildir,
+                      catchout=True, silent=True)
+
+
+
+    def _drop_untracked_missing(self, relpaths, chunk=1000):
+        """Returns relpaths without the paths that are neither in the maildir
+        nor in the git index"""
+        missing = [p for p in relpaths if not os.path.lexists(os.path.join(self.maildir, p))]
+        if len(missing) == 0: return relpaths
+
+        tracked = set()
+        for i in range(0, len(missing), chunk):
+            raw = self._git(['--literal-pathspecs', 'ls-files', '-z', '--'] + missing[i:i+chunk],
+                            tgtdir=self.maildir, catchout=True, silent=True)
+            tracked.update([p for p in raw.split('\0') if len(p) > 0])
+
+        gone = set(missing) - tracked
+        return [p for p in relpaths if not p in gone]
+
+
+
+    def _commit_changed(self, cmt_msg, dryrun=False, silent=False):
+        """Stages only the paths in the change journal and commits them"""
+        rmaildir = os.path.realpath(self.maildir)
+        relpaths = []
+        for p in sorted(self.changed_paths):
+            rp = os.path.join(os.path.realpath(os.path.dirname(p)), os.path.basename(p))
+            if rp.startswith(rmaildir + os.sep):
+                relpaths.append(os.path.relpath(rp, rmaildir))
+
+        # a file can be renamed and then removed during a run, like a message
+        # flagged and then trashed. Its intermediate paths are gone and were
+        # never tracked, and git add fails on them.
+        if not dryrun: relpaths = self._drop_untracked_missing(relpaths)
+
+        if len(relpaths) == 0:
+            ui.print_color("  working dir is clean")
+            return
+
+        ui.print_color("  commiting %d files in %s" % (len(relpaths), self.maildir))
+        if dryrun: return
+
+        import tempfile
+        with tempfile.NamedTemporaryFile(mode='wb', prefix='mutag-pathspec-') as fd:
+            fd.write(b'\0'.join([os.fsencode(p) for p in relpaths]) + b'\0')
+            fd.flush()
+            self._git(['add', '-A', '--pathspec-from-file=%s' % fd.name, '--pathspec-file-nul'],
+                      tgtdir=self.maildir, catchout=True, silent=True)
+
+        # only the index is compared to HEAD, the working tree is not scanned
+        raw = self._git(['diff', '--cached', '--name-only'], tgtdir=self.maildir,
+                        catchout=True, silent=True)
+        if len(raw.strip()) > 0:
+            self._git(['commit', '-m', cmt_msg], tgtdir=self.maildir, catchout=False, silent=True)
+
+
+
+    def _commit_all(self, cmt_msg, dryrun=False, silent=False):
+        """Scans the whole maildir for changes and commits them"""
+        # detect if there are changes on working dir
+        raw = self._git(['status', '--porcelain'], tgtdir=self.maildir,
+                        catchout=True, silent=True)
+
+        # commit only if there are changes
+        if len(raw.strip()) > 0:
+            ui.print_color("  commiting files in %s" % self.maildir)
+            if not dryrun:
+                self._git(['add', '-A', '.'], tgtdir=self.maildir, catchout=False, silent=True)
+                self._git(['commit', '-m', cmt_msg], tgtdir=self.maildir, catchout=False, silent=True)
+
+        else:
+            ui.print_color("  working dir is clean")
+
+
+
+    def commit(self, dryrun=False, silent=False, full=False):
+        """Commits changes in the maildir. If we know which files were changed
+        during this run, only those are staged. Otherwise, or if full is set,
+        falls back to scanning the whole maildir."""
         cmt_msg = "mutag auto-commit"
 
         if not self.under_git:
             ui.print_error("maildir %s not under git version control" % self.maildir)
             return
 
+        self.flush_journal(dryrun=dryrun, silent=silent)
+
         try:
-            # detect if there are changes on working dir
-            raw = self._git(['status', '--porcelain'], tgtdir=self.maildir,
-                            catchout=True, silent=True)
+            with self.stats.phase('commit', count=len(self.changed_paths)):
+                if not dryrun: self._git_setup_fastscan()
 
-            # commit only if there are changes
-            if len(raw.strip()) > 0:
-                ui.print_color("  commiting files in %s" % self.maildir)
-                if not dryrun:
-                    self._git(['add', '-A', '.'], tgtdir=self.maildir, catchout=False, silent=True)
-                    self._git(['commit', '-m', cmt_msg], tgtdir=self.maildir, catchout=False, silent=True)
+                if self.changed_paths and not full:
+                    self._commit_changed(cmt_msg, dryrun=dryrun, silent=silent)
+                else:
+                    self._commit_all(cmt_msg, dryrun=dryrun, silent=silent)
 
-            else:
-                ui.print_color("  working dir is clean")
+            if not dryrun: self.changed_paths = set()
 
         except subprocess.CalledProcessError as err:
             if err.output:  raise MuError(str(err.output.decode('utf-8')))
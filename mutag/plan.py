@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Plans of tag and flag changes, computed by one run and applied by another.
+#
+# A plan is a json-lines file. The first line is a header, and every other line
+# is the change to one file:
+#
+#   {"mutag-plan": 1, "maildir": "...", "created": ...}
+#   {"path": "INBOX/cur/...", "digest": "...", "oldtags": [...], "tags": [...]}
+#
+# Paths are relative to the maildir, so a plan can be applied on another
+# machine. Entries carry tags, flags or both, and the digest of the file when
+# the plan was made. Files whose digest changed since are left alone.
+
+import os
+import json
+import time
+import mmap
+import hashlib
+
+PLAN_VERSION = 1
+
+
+class PlanError(Exception):
+    def __init__(self, msg=None):
+        super().__init__(msg)
+
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size > 0:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+    return h.hexdigest()
+
+
+class Plan(object):
+    def __init__(self, maildir):
+        self.maildir = maildir
+        self.entries = {}       # relative path -> entry dict
+
+
+    def _entry(self, path):
+        rel = os.path.relpath(path, self.maildir)
+        ent = self.entries.get(rel, None)
+        if ent == None:
+            ent = {'path': rel, 'digest': file_digest(path)}
+            self.entries[rel] = ent
+        return ent
+
+
+    def add_tags(self, path, oldtags, newtags):
+        ent = self._entry(path)
+        ent.setdefault('oldtags', sorted(oldtags))
+        ent['tags'] = sorted(newtags)
+
+
+    def add_flags(self, path, oldflags, newflags):
+        ent = self._entry(path)
+        ent.setdefault('oldflags', sorted(oldflags))
+        ent['flags'] = sorted(newflags)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def save(self, path):
+        header = {'mutag-plan': PLAN_VERSION, 'maildir': self.maildir, 'created': time.time()}
+        tmppath = path + '.tmp'
+        with open(tmppath, 'w') as fd:
+            fd.write(json.dumps(header, ensure_ascii=False) + '\n')
+            for rel in sorted(self.entries):
+                fd.write(json.dumps(self.entries[rel], ensure_ascii=False, sort_keys=True) + '\n')
+        os.rename(tmppath, path)
+
+
+
+def load_plan(path):
+    """Returns the header and the list of entries of the plan at path"""
+    with open(path, 'r') as fd:
+        try:
+            header = json.loads(fd.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get('mutag-plan', None) != PLAN_VERSION:
+            raise PlanError("%s is not a mutag plan" % path)
+
+        entries = []
+        for lineno, line in enumerate(fd, 2):
+            if len(line.strip()) == 0: continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                raise PlanError("%s:%d: bad plan entry" % (path, lineno))
+    return header, entries
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -18,37 +18,50 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from pyparsing import *
+_grammar = None
 
-# define punctuation literals
-LPAR, RPAR, LBRK, RBRK, LBRC, RBRC, VBAR = map(Suppress, "()[]{}|")
-DOT, DDOT = map(Suppress, ".:")
 
-decimal  = Regex(r'-?0|[1-9]\d*').setParseAction(lambda t: int(t[0]))
-token    = Word(alphanums + '-')
-qstring  = dblQuotedString.setParseAction(
-           lambda t: [s[1:-1].replace('\\\\', '\\').replace('\\"', '"') for s in t])
-string   = token | qstring
-nil      = Literal("nil").setParseAction(lambda t: [None])
-elem     = nil | token | qstring | string
+def _build_grammar():
+    """Builds the pyparsing grammar. Done on first use, as importing pyparsing
+    and building the grammar is a noticeable part of mutag startup."""
+    global _grammar
+    if _grammar: return _grammar
 
-aitem    = Group(LPAR + elem + DOT + elem + RPAR).setParseAction(lambda t: [tuple(t.asList()[0])])
-alist    = Group(LPAR + ZeroOrMore(aitem) + RPAR).setParseAction(lambda t: t.asList())
-slist    = Group(LPAR + ZeroOrMore(elem) + RPAR).setParseAction(lambda t: t.asList())
+    from pyparsing import Suppress, Regex, Word, alphanums, dblQuotedString, \
+        Literal, Group, ZeroOrMore
 
-pkey     = DDOT + token
-elplist  = Group(LPAR + ZeroOrMore(Group(pkey + elem)) + RPAR).setParseAction(lambda t: {k: v for k, v in t[0]})
+    # define punctuation literals
+    LPAR, RPAR, LBRK, RBRK, LBRC, RBRC, VBAR = map(Suppress, "()[]{}|")
+    DOT, DDOT = map(Suppress, ".:")
 
-pvalue   = alist | slist | elplist | elem
-plist    = Group(LPAR + ZeroOrMore(Group(pkey + pvalue)) + RPAR).setParseAction(lambda t: {k: v for k, v in t[0]})
-plistseq = ZeroOrMore(plist)
+    decimal  = Regex(r'-?0|[1-9]\d*').setParseAction(lambda t: int(t[0]))
+    token    = Word(alphanums + '-')
+    qstring  = dblQuotedString.setParseAction(
+               lambda t: [s[1:-1].replace('\\\\', '\\').replace('\\"', '"') for s in t])
+    string   = token | qstring
+    nil      = Literal("nil").setParseAction(lambda t: [None])
+    elem     = nil | token | qstring | string
+
+    aitem    = Group(LPAR + elem + DOT + elem + RPAR).setParseAction(lambda t: [tuple(t.asList()[0])])
+    alist    = Group(LPAR + ZeroOrMore(aitem) + RPAR).setParseAction(lambda t: t.asList())
+    slist    = Group(LPAR + ZeroOrMore(elem) + RPAR).setParseAction(lambda t: t.asList())
+
+    pkey     = DDOT + token
+    elplist  = Group(LPAR + ZeroOrMore(Group(pkey + elem)) + RPAR).setParseAction(lambda t: {k: v for k, v in t[0]})
+
+    pvalue   = alist | slist | elplist | elem
+    plist    = Group(LPAR + ZeroOrMore(Group(pkey + pvalue)) + RPAR).setParseAction(lambda t: {k: v for k, v in t[0]})
+    plistseq = ZeroOrMore(plist)
+
+    _grammar = {'plist': plist, 'plistseq': plistseq}
+    return _grammar
 
 
 def parse_seq(raw):
-    pls = plistseq.parseString(raw)
+    pls = _build_grammar()['plistseq'].parseString(raw)
     return pls.asList()
 
 
 def parse_plist(raw):
-    pls = plist.parseString(raw)
+    pls = _build_grammar()['plist'].parseString(raw)
     return pls.asList()[0]
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A long lived mutag process listening on a unix socket.
+#
+# The protocol is deliberately tiny, so the client does not need to import
+# anything beyond the standard library socket module:
+#
+#   client -> server: a single json line {"argv": [...], "cwd": "...", "isatty": bool,
+#                                         "stdin": "..."}
+#   server -> client: a sequence of frames <channel:1><length:4><payload>
+#
+# where channel is 'o' for stdout, 'e' for stderr and 'x' for the exit status,
+# which is always the last frame.
+#
+# stdin is only sent when the command reads it, as with --batch -. Commands
+# never see the stdin of the server, without it they read an empty one.
+
+import io
+import os
+import sys
+import json
+import socket
+import struct
+
+
+def default_socket_path():
+    rundir = os.environ.get('XDG_RUNTIME_DIR', None)
+    if rundir:
+        return os.path.join(rundir, 'mutag.sock')
+    else:
+        return '/tmp/mutag-%d.sock' % os.getuid()
+
+
+def write_frame(sock, channel, payload):
+    sock.sendall(channel + struct.pack('!I', len(payload)) + payload)
+
+
+def read_exact(sock, n):
+    buf = b''
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise EOFError("connection closed by server")
+        buf = buf + chunk
+    return buf
+
+
+def read_frame(sock):
+    head = read_exact(sock, 5)
+    channel = head[0:1]
+    length = struct.unpack('!I', head[1:5])[0]
+    return channel, read_exact(sock, length)
+
+
+
+class FrameBuffer(object):
+    """Binary counterpart of FrameWriter, used as its buffer attribute"""
+
+    def __init__(self, sock, channel):
+        self.sock = sock
+        self.channel = channel
+
+    def write(self, data):
+        if len(data) > 0:
+            write_frame(self.sock, self.channel, bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+
+class FrameWriter(object):
+    """A file-like object that forwards everything written to it to the client
+    through the socket as frames of the given channel."""
+
+    encoding = 'utf-8'
+
+    def __init__(self, sock, channel, tty=False):
+        self.sock = sock
+        self.channel = channel
+        self.tty = tty
+        self.buffer = FrameBuffer(sock, channel)
+
+    def write(self, text):
+        if len(text) > 0:
+            write_frame(self.sock, self.channel, text.encode(self.encoding, errors='replace'))
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self.tty
+
+    def fileno(self):
+        raise OSError("frame writer has no file descriptor")
+
+
+
+def _handle_connection(conn, handler):
+    fd = conn.makefile('rb')
+    try:
+        line = fd.readline()
+    finally:
+        fd.close()
+
+    if not line: return
+    req = json.loads(line.decode('utf-8'))
+
+    out = FrameWriter(conn, b'o', tty=req.get('isatty', False))
+    err = FrameWriter(conn, b'e', tty=False)
+
+    oldin, oldout, olderr = sys.stdin, sys.stdout, sys.stderr
+    oldcwd = os.getcwd()
+    code = 0
+    try:
+        sys.stdin = io.StringIO(req.get('stdin', None) or '')
+        sys.stdout, sys.stderr = out, err
+        os.chdir(req.get('cwd', oldcwd))
+        code = handler(req.get('argv', []))
+
+    except SystemExit as e:
+        if e.code is None:           code = 0
+        elif isinstance(e.code, int): code = e.code
+        else:
+            err.write('%s\n' % e.code)
+            code = 1
+
+    except Exception:
+        import traceback
+        err.write(traceback.format_exc())
+        code = 1
+
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = oldin, oldout, olderr
+        os.chdir(oldcwd)
+
+    write_frame(conn, b'x', struct.pack('!i', code or 0))
+
+
+
+def serve(sockpath, handler):
+    """Listen on sockpath and run handler(argv) for every client request.
+    Requests are served one at a time, so the handler may keep state between
+    calls without any locking."""
+    if os.path.exists(sockpath):
+        os.unlink(sockpath)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    oldmask = os.umask(0o077)
+    try:
+        sock.bind(sockpath)
+    finally:
+        os.umask(oldmask)
+    sock.listen(16)
+
+    try:
+        while True:
+            conn, addr = sock.accept()
+            try:
+                _handle_connection(conn, handler)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                conn.close()
+    finally:
+        sock.close()
+        if os.path.exists(sockpath):
+            os.unlink(sockpath)
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Time spent by a mutag command, per phase, and counters of what it did.
+#
+# Phases accumulate wall time, cpu time and a count of the items they handled.
+# They are measured where the work is done, so they may nest: the index phase
+# includes the writes of the journal flush it does first.
+#
+# The stats of a run can be written as json, or in the Prometheus textfile
+# format for node_exporter.
+
+import os
+import json
+import time
+
+from contextlib import contextmanager
+
+
+# counters always present in the output, with their descriptions
+COUNTERS = [('processed',       'Messages looked at by the command'),
+            ('retagged',        'Messages whose tags changed'),
+            ('expired',         'Messages expired'),
+            ('bytes_rewritten', 'Bytes of message files rewritten'),
+            ('files_scanned',   'Files found walking the maildir'),
+            ('mu_calls',        'mu subprocesses run'),
+            ('mu_seconds',      'Wall time spent in mu subprocesses'),
+            ('throttle_seconds', 'Time spent waiting in background mode')]
+
+
+class Stats(object):
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        self.phases = {}      # name -> [wall, cpu, count]
+        self.counters = {name: 0 for name, desc in COUNTERS}
+        self.started = time.time()
+
+
+    def start(self):
+        return (time.perf_counter(), time.process_time())
+
+
+    def stop(self, name, start, count=1):
+        """Charges the time since start to the phase name. Returns the wall
+        time."""
+        wall = time.perf_counter() - start[0]
+        cpu = time.process_time() - start[1]
+        self.add(name, wall, cpu, count)
+        return wall
+
+
+    def add(self, name, wall, cpu, count=1):
+        """Charges time measured elsewhere to the phase name"""
+        ph = self.phases.get(name, None)
+        if ph == None:
+            self.phases[name] = [wall, cpu, count]
+        else:
+            ph[0] = ph[0] + wall
+            ph[1] = ph[1] + cpu
+            ph[2] = ph[2] + count
+
+
+    @contextmanager
+    def phase(self, name, count=0):
+        t = self.start()
+        try:
+            yield
+        finally:
+            self.stop(name, t, count)
+
+
+    def count(self, name, count=1):
+        """Adds to the item count of a phase, without timing anything"""
+        ph = self.phases.setdefault(name, [0.0, 0.0, 0])
+        ph[2] = ph[2] + count
+
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def iterate(self, name, it):
+        """Yields the items of it, charging the time spent producing each one
+        to the phase name"""
+        it = iter(it)
+        while True:
+            t = self.start()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.stop(name, t, 0)
+                return
+            self.stop(name, t, 1)
+            yield item
+
+
+    def report(self):
+        """Returns a list of (phase, wall, cpu, count), in the order phases
+        were first seen"""
+        return [(name, ph[0], ph[1], ph[2]) for name, ph in self.phases.items()]
+
+
+    def todict(self):
+        return {'started': self.started,
+                'counters': dict(self.counters),
+                'phases': {name: {'wall_seconds': wall, 'cpu_seconds': cpu, 'items': count}
+                           for name, wall, cpu, count in self.report()}}
+
+
+
+def _prom_labels(labels):
+    if not labels: return ''
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(['%s="%s"' % (k, esc(v)) for k, v in sorted(labels.items())]) + '}'
+
+
+def to_prometheus(runs, prefix='mutag'):
+    """Renders a list of (stats dict, labels) in the Prometheus text
+    exposition format. Values are those of the last run, so everything is a
+    gauge."""
+    L = []
+
+    def metric(name, desc, samples):
+        L.append('# HELP %s_%s %s' % (prefix, name, desc))
+        L.append('# TYPE %s_%s gauge' % (prefix, name))
+        for labels, value in samples:
+            L.append('%s_%s%s %s' % (prefix, name, _prom_labels(labels), repr(float(value))))
+
+    metric('last_run_timestamp_seconds', 'Time the last run started',
+           [(labels, d['started']) for d, labels in runs])
+
+    desc = dict(COUNTERS)
+    names = sorted(set([n for d, labels in runs for n in d['counters']]))
+    for name in names:
+        metric(name, desc.get(name, name),
+               [(labels, d['counters'][name]) for d, labels in runs if name in d['counters']])
+
+    for key, name, desc in [('wall_seconds', 'phase_wall_seconds', 'Wall time per phase'),
+                            ('cpu_seconds', 'phase_cpu_seconds', 'Cpu time per phase'),
+                            ('items', 'phase_items', 'Items handled per phase')]:
+        metric(name, desc, [(dict(labels, phase=ph), val[key])
+                            for d, labels in runs for ph, val in d['phases'].items()])
+    return '\n'.join(L) + '\n'
+
+
+def write_metrics(runs, path, fmt=None):
+    """Writes a list of (stats dict, labels), one per run, to path as json or
+    prometheus. If fmt is None, it is guessed from the extension. The file is
+    replaced atomically, so a collector never sees half of it."""
+    if fmt == None:
+        fmt = 'json' if path.endswith('.json') else 'prometheus'
+
+    if fmt == 'json':
+        text = json.dumps({'runs': [dict(d, labels=labels) for d, labels in runs]}, sort_keys=True) + '\n'
+    else:
+        text = to_prometheus(runs)
+
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmppath, 'w') as fd:
+        fd.write(text)
+    os.rename(tmppath, path)
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
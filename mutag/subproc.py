@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Subprocesses whose output is consumed as a stream of lines.
+#
+# stderr is drained by a thread while the caller reads stdout, so a chatty
+# process can never block on a full stderr pipe. Only the tail of stderr is
+# kept. A process can be given a timeout, after which it is killed, and can be
+# cancelled from any thread. Stopping the iteration early kills it too.
+#
+# The process runs in its own session, so killing it takes its children along,
+# and none of them is left holding stdout open.
+
+import os
+import signal
+import threading
+import subprocess
+
+from collections import deque
+
+
+class StreamProcess(object):
+    def __init__(self, args, timeout=None, stderr_limit=64*1024):
+        self.args = args
+        self.returncode = None
+        self.timed_out = False
+        self.cancelled = False
+
+        self._stderr = deque()
+        self._stderr_size = 0
+        self._stderr_limit = stderr_limit
+
+        self.proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     encoding='utf-8', errors='replace',
+                                     start_new_session=True)
+
+        self._drain = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._drain.start()
+
+        self._timer = None
+        if timeout:
+            self._timer = threading.Timer(timeout, self._on_timeout)
+            self._timer.daemon = True
+            self._timer.start()
+
+
+    def _drain_stderr(self):
+        try:
+            for chunk in iter(lambda: self.proc.stderr.read(4096), ''):
+                self._stderr.append(chunk)
+                self._stderr_size = self._stderr_size + len(chunk)
+                while self._stderr_size > self._stderr_limit and len(self._stderr) > 1:
+                    self._stderr_size = self._stderr_size - len(self._stderr.popleft())
+        finally:
+            self.proc.stderr.close()
+
+
+    def _kill(self):
+        if self.proc.poll() == None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+    def _on_timeout(self):
+        self.timed_out = True
+        self._kill()
+
+
+    def cancel(self):
+        """Kills the process. Safe to call from any thread."""
+        self.cancelled = True
+        self._kill()
+
+
+    def stderr(self, lines=None):
+        """The tail of what the process wrote to stderr, or its last lines"""
+        text = ''.join(self._stderr)
+        if lines: text = '\n'.join(text.rstrip('\n').split('\n')[-lines:])
+        return text
+
+
+    def _finish(self):
+        self.proc.stdout.close()
+        self.returncode = self.proc.wait()
+        if self._timer: self._timer.cancel()
+        # the session is gone, so stderr is at eof or about to be
+        self._drain.join(1.0)
+
+
+    def lines(self):
+        """Yields the lines of stdout. When done, returncode is set."""
+        done = False
+        try:
+            for line in self.proc.stdout:
+                yield line
+            done = True
+        finally:
+            if not done: self.cancel()
+            self._finish()
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A sqlite index of the tags and flags of every message in the maildir, so
+# questions about tags can be answered without going through mu.
+
+import os
+import re
+import shlex
+import sqlite3
+import calendar
+
+_schema = """
+CREATE TABLE IF NOT EXISTS messages (
+    path     TEXT PRIMARY KEY,
+    msgid    TEXT,
+    maildir  TEXT,
+    date     INTEGER,
+    mtime    REAL,
+    size     INTEGER
+);
+CREATE TABLE IF NOT EXISTS tags (
+    tag      TEXT,
+    path     TEXT,
+    PRIMARY KEY (tag, path)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS flags (
+    flag     TEXT,
+    path     TEXT,
+    PRIMARY KEY (flag, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_path ON tags (path);
+CREATE INDEX IF NOT EXISTS flags_path ON flags (path);
+"""
+
+# commit after this many updates
+_batch_size = 1000
+
+
+class TagIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # mu matches tags without regard to case, and sqlite lower() only
+        # knows about ascii
+        self.db.create_function('pylower', 1, lambda t: t.lower() if t != None else None,
+                                deterministic=True)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(_schema)
+        self._pending = 0
+
+
+    def commit(self):
+        self.db.commit()
+        self._pending = 0
+
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+    def _changed(self):
+        self._pending = self._pending + 1
+        if self._pending >= _batch_size: self.commit()
+
+
+    def remove(self, path):
+        self.db.execute('DELETE FROM messages WHERE path = ?', (path,))
+        self.db.execute('DELETE FROM tags WHERE path = ?', (path,))
+        self.db.execute('DELETE FROM flags WHERE path = ?', (path,))
+        self._changed()
+
+
+    def update(self, msg, oldpath=None):
+        """Stores the current state of msg. If the message was renamed, oldpath
+        is its previous path."""
+        path = msg['path']
+        if oldpath and oldpath != path:
+            self.remove(oldpath)
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.remove(path)
+            return
+
+        if msg.get('date', None): date = calendar.timegm(msg['date'].timetuple())
+        else:                     date = None
+
+        self.db.execute('INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)',
+                        (path, msg.get('message-id', None), msg.get('maildir', None),
+                         date, st.st_mtime, st.st_size))
+
+        self.db.execute('DELETE FROM tags WHERE path = ?', (path,))
+        self.db.executemany('INSERT INTO tags VALUES (?, ?)',
+                            [(t, path) for t in msg.get('tags', [])])
+
+        self.db.execute('DELETE FROM flags WHERE path = ?', (path,))
+        self.db.executemany('INSERT INTO flags VALUES (?, ?)',
+                            [(f, path) for f in msg.get('flags', [])])
+        self._changed()
+
+
+    def empty(self):
+        return self.db.execute('SELECT 1 FROM messages LIMIT 1').fetchone() == None
+
+
+    def knows_maildirs(self):
+        """Whether every message has its maildir. Older versions left it out
+        for nested folders."""
+        return self.db.execute('SELECT 1 FROM messages WHERE maildir IS NULL LIMIT 1').fetchone() == None
+
+
+    def mtimes(self):
+        """Returns a dict path -> (mtime, size) for all indexed files"""
+        cur = self.db.execute('SELECT path, mtime, size FROM messages')
+        return {p: (mt, sz) for p, mt, sz in cur}
+
+
+    def histogram(self):
+        """Returns a list of (tag, count), most used tags first"""
+        cur = self.db.execute('SELECT tag, COUNT(*) AS n FROM tags GROUP BY tag ORDER BY n DESC, tag')
+        return list(cur)
+
+
+    def _where(self, terms):
+        conds = []
+        params = []
+        for neg, field, value in terms:
+            if field == 'tag':
+                sub = 'path IN (SELECT path FROM tags WHERE pylower(tag) = ?)'
+                value = value.lower()
+            elif field == 'flag':
+                sub = 'path IN (SELECT path FROM flags WHERE flag = ?)'
+                value = value.lower()
+            elif field == 'maildir':
+                sub = 'maildir = ?'
+            if neg: sub = 'NOT ' + sub
+            conds.append(sub)
+            params.append(value)
+
+        if len(conds) == 0: return '', []
+        else:               return ' WHERE ' + ' AND '.join(conds), params
+
+
+    def count(self, terms):
+        where, params = self._where(terms)
+        return self.db.execute('SELECT COUNT(*) FROM messages' + where, params).fetchone()[0]
+
+
+    def paths(self, terms):
+        where, params = self._where(terms)
+        for row in self.db.execute('SELECT path FROM messages' + where + ' ORDER BY date', params):
+            yield row[0]
+
+
+
+_term_re = re.compile(r'^(-)?(tag|flag|maildir):(.+)$', flags=re.IGNORECASE)
+
+# the flags in maildir file names, the only ones the index knows for sure. mu
+# also has unread, new, attach, list, personal... and one letter forms.
+_index_flags = set(['draft', 'flagged', 'seen', 'passed', 'replied', 'trashed'])
+
+def parse_query(query):
+    """If query is a conjunction of tag:, flag: and maildir: terms, possibly
+    negated, that the index answers like mu, returns a list of (negated,
+    field, value). Otherwise returns None, meaning the query needs mu."""
+    if query == None: return []
+
+    try:
+        tokens = shlex.split(query)
+    except ValueError:
+        return None
+
+    terms = []
+    neg = False
+    for tk in tokens:
+        if tk.upper() == 'AND':
+            continue
+        elif tk.upper() == 'NOT':
+            neg = not neg
+            continue
+
+        m = _term_re.match(tk)
+        if not m: return None
+        field, value = m.group(2).lower(), m.group(3)
+        if field == 'flag' and not value.lower() in _index_flags: return None
+        # mu wildcards and regexps
+        if '*' in value: return None
+        if len(value) > 1 and value[0] == '/' and value[-1] == '/': return None
+        terms.append((neg or bool(m.group(1)), field, value))
+        neg = False
+
+    if neg: return None
+    return terms
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mutag - A tagging tool for mails indexed by mu
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Background mode. Paces file writes to a number of files and bytes per
+# second, and waits while the system load is over a threshold. It plugs into
+# the write and parse hooks, so it costs nothing unless enabled.
+
+import os
+import time
+import shutil
+import threading
+import subprocess
+
+import mutag.archui as ui
+
+
+def lower_priority(niceness=10):
+    """Lowers the cpu priority of this process, and moves it to the idle io
+    scheduling class if ionice is around. There is no going back."""
+    try:
+        os.nice(niceness)
+    except OSError as err:
+        ui.print_debug("could not renice: %s" % str(err))
+
+    ionice = shutil.which('ionice')
+    if ionice:
+        try:
+            subprocess.check_call([ionice, '-c', '3', '-p', str(os.getpid())],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError) as err:
+            ui.print_debug("could not set io priority: %s" % str(err))
+
+
+class Throttle(object):
+    def __init__(self, files_per_sec=0, bytes_per_sec=0, max_load=0, stats=None):
+        self.files_per_sec = files_per_sec      # 0 means no limit
+        self.bytes_per_sec = bytes_per_sec
+        self.max_load = max_load
+        self.stats = stats
+
+        self.load_interval = 1.0    # seconds between load checks
+        self._next = 0              # monotonic time the next write may start
+        self._last_load = 0
+        self._lock = threading.Lock()   # plan workers write from threads
+
+
+    def install(self, hooks):
+        hooks.register('before-write', self._before_write, tag='throttle')
+        hooks.register('after-write', self._after_write, tag='throttle')
+        hooks.register('before-parse', self._before_parse, tag='throttle')
+
+
+    def _sleep(self, secs):
+        time.sleep(secs)
+        if self.stats: self.stats.incr('throttle_seconds', secs)
+
+
+    def wait_load(self):
+        """Sleeps while the load average is over max_load. Only looks at the
+        load once per load_interval."""
+        if self.max_load <= 0: return
+        now = time.monotonic()
+        if now - self._last_load < self.load_interval: return
+
+        while os.getloadavg()[0] > self.max_load:
+            self._sleep(5*self.load_interval)
+        self._last_load = time.monotonic()
+
+
+    def wait_write(self):
+        """Waits for the turn of the next write. The turn is taken right away,
+        so concurrent writers queue up behind each other."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start
+            if self.files_per_sec > 0: self._next = start + 1.0 / self.files_per_sec
+        if start > now: self._sleep(start - now)
+        self.wait_load()
+
+
+    def account(self, nbytes):
+        """Records a write of nbytes, pushing back the next one if the bytes
+        take longer than the file rate allows"""
+        if self.bytes_per_sec <= 0: return
+        extra = float(nbytes) / self.bytes_per_sec
+        if self.files_per_sec > 0: extra = extra - 1.0 / self.files_per_sec
+        if extra <= 0: return
+        with self._lock:
+            self._next = max(time.monotonic(), self._next) + extra
+
+
+
+    def _before_write(self, event, info):
+        self.wait_write()
+
+
+    def _after_write(self, event, info):
+        self.account(info.get('size', 0))
+
+
+    def _before_parse(self, event, info):
+        self.wait_load()
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -27,7 +27,7 @@ setup(name         = 'mutag',
       author       = 'Abdó Roig-Maranges',
       author_email = 'abdo.roig@gmail.com',
       packages     = ['mutag', 'mutag.archui'],
-      scripts      = ['bin/mutag'])
+      scripts      = ['bin/mutag', 'bin/mutagc'])
 
 
 # vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80